@@ -9,21 +9,91 @@ FFmpeg Video Processing Service
 A Flask-based microservice for video processing using FFmpeg
 """
 
+import io
 import os
 import json
 import re
-import uuid
+import shlex
+import shutil
 import subprocess
 import time
 import threading
+import heapq
+import itertools
+import queue
+import atexit
 import logging
 import logging.handlers
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from hashlib import blake2b
 from urllib.parse import urlparse
+from secrets import token_hex
 import requests
-from flask import Flask, request, jsonify, send_file
-from werkzeug.utils import secure_filename
-from functools import wraps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.utils import secure_filename, send_file
+from functools import wraps, lru_cache
+from contextlib import ExitStack
+
+try:
+    import av  # optional: in-process libav metadata, falls back to the ffprobe binary
+    from av.subtitles.codeccontext import SubtitleCodecContext
+except ImportError:
+    av = None
+
+# The in-process paths use PyAV APIs newer than some installs ship; check once and keep
+# each feature on the ffmpeg/ffprobe binaries when its API is missing
+_PYAV_PROBE = av is not None and hasattr(av.Codec, "canonical_name")
+_PYAV_FRAME_ROTATION = av is not None and hasattr(av.VideoFrame, "rotation")
+_PYAV_SUBTITLE_MUX = av is not None and all(
+    hasattr(SubtitleCodecContext, attr)
+    for attr in ("decode2", "encode_subtitle", "subtitle_header")
+)
+
+try:
+    import orjson  # optional: faster JSON encoding/decoding for the API
+except ImportError:
+    orjson = None
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that leaves records in a file buffer instead of flushing
+    (one write syscall) per record; FlushingQueueListener flushes it when idle"""
+
+    def __init__(self, filename, buffer_size, **kwargs):
+        self.buffer_size = buffer_size
+        super().__init__(filename, **kwargs)
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.buffer_size,
+                    encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record):
+        # BaseRotatingHandler.emit without StreamHandler's per-record flush
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """QueueListener that flushes its handlers whenever the queue runs dry, so a burst
+    of records reaches the log file in a few large writes and a quiet one right away"""
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get(block=False)
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
 
 # Configure logging
 def setup_logging():
@@ -60,16 +130,38 @@ def setup_logging():
     console_handler = logging.StreamHandler()
     console_handler.setLevel(log_level)
     console_handler.setFormatter(simple_formatter)
-    root_logger.addHandler(console_handler)
     
     # File handler for all logs
     all_log_file = os.path.join(log_dir, "all.log")
-    file_handler = logging.handlers.RotatingFileHandler(
-        all_log_file, maxBytes=10*1024*1024, backupCount=5
+    file_handler = BufferedRotatingFileHandler(
+        all_log_file, buffer_size=1024*1024, maxBytes=10*1024*1024, backupCount=5
     )
     file_handler.setLevel(log_level)
     file_handler.setFormatter(detailed_formatter)
-    root_logger.addHandler(file_handler)
+
+    # Request threads only enqueue records; a listener thread does the writes and rotation
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    root_logger.addHandler(queue_handler)
+    _log_listener = FlushingQueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    _log_listener.start()
+
+    def _restart_listener_in_child():
+        # threads don't survive fork (gunicorn --preload): give the child its own queue and writer
+        child_queue = queue.SimpleQueue()
+        queue_handler.queue = child_queue
+        _log_listener.queue = child_queue
+        _log_listener._thread = None
+        _log_listener.start()
+
+    if hasattr(os, "register_at_fork"):
+        # flush first, or the child inherits the buffered records and writes them again
+        os.register_at_fork(before=file_handler.flush, after_in_child=_restart_listener_in_child)
     
     # Suppress Flask and Werkzeug logs in production
     if os.getenv("FLASK_DEBUG", "false").lower() not in ("true", "1", "yes", "on"):
@@ -79,9 +171,19 @@ def setup_logging():
     return root_logger
 
 # Initialize logging
+_log_listener = None
 logger = setup_logging()
+atexit.register(lambda: _log_listener and _log_listener.stop())
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Decode request bodies with orjson; encoding stays on Flask's provider"""
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)  # raises a ValueError subclass, as get_json expects
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 # Configuration from environment variables
 TEMP_DIR = os.getenv("TEMP_DIR", "/tmp/videos")
@@ -96,33 +198,72 @@ app.config["MAX_CONTENT_LENGTH"] = MAX_FILE_SIZE
 allowed_ext_str = os.getenv(
     "ALLOWED_VIDEO_EXTENSIONS", "mp4,avi,mov,mkv,flv,wmv,webm,m4v"
 )
-ALLOWED_VIDEO_EXTENSIONS = {
-    f".{ext.strip()}" for ext in allowed_ext_str.split(",")
-}
+ALLOWED_VIDEO_EXTENSIONS = frozenset(
+    f".{ext.strip().lower().lstrip('.')}" for ext in allowed_ext_str.split(",") if ext.strip()
+)
 
 # Parse allowed audio extensions from environment
 allowed_audio_ext_str = os.getenv(
     "ALLOWED_AUDIO_EXTENSIONS", "mp3,wav,flac,aac,ogg,m4a,wma,opus"
 )
-ALLOWED_AUDIO_EXTENSIONS = {
-    f".{ext.strip()}" for ext in allowed_audio_ext_str.split(",")
-}
+ALLOWED_AUDIO_EXTENSIONS = frozenset(
+    f".{ext.strip().lower().lstrip('.')}" for ext in allowed_audio_ext_str.split(",") if ext.strip()
+)
 
 # Parse supported video output formats from environment
 video_output_fmt_str = os.getenv(
     "SUPPORTED_VIDEO_OUTPUT_FORMATS", "mp4,avi,mov,mkv,webm"
 )
-SUPPORTED_VIDEO_OUTPUT_FORMATS = {
-    fmt.strip() for fmt in video_output_fmt_str.split(",")
-}
+SUPPORTED_VIDEO_OUTPUT_FORMATS = frozenset(
+    fmt.strip().lower() for fmt in video_output_fmt_str.split(",") if fmt.strip()
+)
 
 # Parse supported audio output formats from environment
 audio_output_fmt_str = os.getenv(
     "SUPPORTED_AUDIO_OUTPUT_FORMATS", "mp3,wav,flac,aac,ogg,m4a,opus"
 )
-SUPPORTED_AUDIO_OUTPUT_FORMATS = {
-    fmt.strip() for fmt in audio_output_fmt_str.split(",")
-}
+SUPPORTED_AUDIO_OUTPUT_FORMATS = frozenset(
+    fmt.strip().lower() for fmt in audio_output_fmt_str.split(",") if fmt.strip()
+)
+
+# Every accepted upload suffix, longest first, for a single str.endswith check
+_ALLOWED_MEDIA_SUFFIXES = tuple(
+    sorted(ALLOWED_VIDEO_EXTENSIONS | ALLOWED_AUDIO_EXTENSIONS, key=len, reverse=True)
+)
+
+# Hand /download bodies to the front web server via X-Sendfile (Apache/lighttpd)
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "false").lower() in ("true", "1", "yes", "on")
+# nginx equivalent: internal location (e.g. /_internal) that aliases TEMP_DIR
+X_ACCEL_REDIRECT = os.getenv("X_ACCEL_REDIRECT", "").rstrip("/")
+
+# Buffer size for streaming URL downloads and uploads to disk
+IO_BUFFER_SIZE = 1024 * 1024  # 1MB
+
+# (connect, read) timeouts for URL downloads
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Keep URL downloads as cache_* files and revalidate them with ETag / Last-Modified;
+# unused entries age out with FILE_RETENTION_HOURS like any other output. Off by default:
+# inputs then outlive their request instead of being removed when it finishes
+URL_CACHE = os.getenv("URL_CACHE", "false").lower() == "true"
+
+# Let ffmpeg read single-use URL inputs (e.g. a BGM track) itself while it encodes,
+# instead of downloading them to TEMP_DIR first; such inputs skip MAX_FILE_SIZE and URL_CACHE
+STREAM_URL_INPUTS = os.getenv("STREAM_URL_INPUTS", "false").lower() == "true"
+
+# One pooled HTTP session per process so repeat downloads from a host reuse
+# the TCP/TLS connection; connect errors are retried with a short backoff
+_http = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.3, allowed_methods=frozenset({"GET"})),
+)
+_http.mount("https://", _http_adapter)
+_http.mount("http://", _http_adapter)
+atexit.register(_http.close)
+
+# Downloads are network-bound, so a request's URL inputs are fetched side by side
+_download_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="download")
 
 # API Key authentication configuration
 API_KEYS_STR = os.getenv("API_KEYS", "")
@@ -139,13 +280,300 @@ BASE_URL = os.getenv("BASE_URL", "").rstrip("/")  # Remove trailing slash
 FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", "2"))
 FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", "300"))  # seconds
 _ffmpeg_sem = threading.Semaphore(FFMPEG_CONCURRENCY)
+# Encodes on a hardware H.264 encoder barely load the CPU and one process rarely keeps the
+# encoder block busy, so they take slots from their own limit instead of FFMPEG_CONCURRENCY
+HW_ENCODER_CONCURRENCY = int(os.getenv("HW_ENCODER_CONCURRENCY", "2"))
+_hw_encoder_sem = threading.BoundedSemaphore(HW_ENCODER_CONCURRENCY)
+# ffprobe runs are short and mostly wait on I/O; a separate, wider limit keeps
+# metadata lookups from queueing behind long transcodes
+FFPROBE_CONCURRENCY = int(os.getenv("FFPROBE_CONCURRENCY", str(os.cpu_count() or 4)))
+_ffprobe_sem = threading.Semaphore(FFPROBE_CONCURRENCY)
+
+# Threads per ffmpeg process so that concurrent jobs together roughly fill the CPUs
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "0")) or max(1, (os.cpu_count() or 4) // FFMPEG_CONCURRENCY)
+
+# CPU/IO priority of ffmpeg runs so transcodes yield to request handling (0 / false to disable)
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "10"))
+FFMPEG_IONICE = os.getenv("FFMPEG_IONICE", "false").lower() == "true"
+
+def ffmpeg_threads(threads=None):
+    """Decoder and filtergraph thread caps; goes right before an -i"""
+    threads = str(threads or FFMPEG_THREADS)
+    return ["-threads", threads, "-filter_threads", threads]
+
+# Pool for running independent ffmpeg jobs of one request side by side
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="media-job")
+
+# Background /process jobs (async=true): runner threads and how many may wait in line
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+_job_executor = ThreadPoolExecutor(max_workers=JOB_CONCURRENCY, thread_name_prefix="bg-job")
+_job_slots = threading.BoundedSemaphore(JOB_CONCURRENCY + JOB_QUEUE_SIZE)
+# A running job's screenshot and conversion runs are each capped by FFMPEG_TIMEOUT;
+# one still "running" well past that lost its worker without a trace (e.g. pid reused)
+JOB_STALE_SECONDS = 2 * FFMPEG_TIMEOUT + 60
+
+# Expired files are unlinked side by side, so slow metadata updates (e.g. network
+# storage) don't queue up behind each other; sweeps hand them over in batches
+CLEANUP_WORKERS = int(os.getenv("CLEANUP_WORKERS", "8"))
+CLEANUP_BATCH = 256
+_cleanup_executor = ThreadPoolExecutor(max_workers=CLEANUP_WORKERS, thread_name_prefix="cleanup")
+
+@lru_cache(maxsize=None)
+def _ffmpeg_priority_prefix():
+    """nice/ionice wrapper for ffmpeg runs; a command prefix keeps the spawn free of preexec_fn"""
+    prefix = []
+    if FFMPEG_IONICE and shutil.which("ionice"):
+        prefix += [shutil.which("ionice"), "-c2", "-n7"]
+    if FFMPEG_NICE and shutil.which("nice"):
+        prefix += [shutil.which("nice"), "-n", str(FFMPEG_NICE)]
+    return tuple(prefix)
+
+def _ffmpeg_slot(cmd):
+    """Semaphore an ffmpeg job runs under: the hardware encoder's if it encodes on one"""
+    if any(arg in HW_H264_ENCODERS for arg in cmd):
+        return _hw_encoder_sem
+    return _ffmpeg_sem
 
 def run_cmd(cmd, **kwargs):
     """Wrapper for subprocess.run with semaphore + default timeout"""
     timeout = kwargs.pop("timeout", FFMPEG_TIMEOUT)
-    with _ffmpeg_sem:
+    # keep the launch on CPython's vfork fast path (no preexec_fn); stdin is
+    # closed off so ffmpeg never waits on the terminal
+    if kwargs.pop("capture_output", False):
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    kwargs.setdefault("stdin", subprocess.DEVNULL)
+    kwargs.setdefault("close_fds", True)
+    if cmd[0] == "ffprobe":
+        sem, prefix = _ffprobe_sem, ()
+    else:
+        sem, prefix = _ffmpeg_slot(cmd), _ffmpeg_priority_prefix()
+    cmd = [*prefix, *cmd]
+    with sem:
         return subprocess.run(cmd, timeout=timeout, **kwargs)
 
+# ffmpeg puts the error that ended a run last; error messages keep this much of stderr
+STDERR_TAIL = 4096
+
+def _stderr_tail(data):
+    return data[-STDERR_TAIL:].decode("utf-8", "replace")
+
+def run_ffmpeg(cmd, **kwargs):
+    """run_cmd for an ffmpeg job: stdout is discarded and stderr carries no banner or
+    progress stats, so only the diagnostics needed for an error message are buffered.
+
+    stderr stays bytes until a run fails; the result then carries its decoded tail.
+    """
+    cmd = [cmd[0], "-hide_banner", "-nostats", *cmd[1:]]
+    r = run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, **kwargs)
+    r.stderr = _stderr_tail(r.stderr) if r.returncode != 0 else ""
+    return r
+
+def log_cmd(label, cmd):
+    """Debug-log a shell-quoted command line; the string is only built when DEBUG is enabled"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s %s", label, shlex.join(map(str, cmd)))
+
+# H.264 encoder: "auto" picks the first working hardware encoder, else libx264
+VIDEO_ENCODER = os.getenv("VIDEO_ENCODER", "auto").strip().lower()
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+HW_H264_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_vaapi", "h264_videotoolbox")
+# Decoder hwaccel used alongside a hardware encoder ("none" decodes in software)
+VIDEO_HWACCEL = os.getenv("VIDEO_HWACCEL", "auto").strip().lower()
+# libx264 preset for conversions; veryfast is ~2x medium's speed at a modest size cost
+X264_PRESET = os.getenv("X264_PRESET", "veryfast")
+
+def h264_input_args(encoder):
+    """Input-side options an H.264 encoder needs (placed before -i)"""
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE]
+    return []
+
+def h264_decode_args(encoder):
+    """-hwaccel for the source when encoding on the GPU (frames still land in system memory)"""
+    if encoder in HW_H264_ENCODERS and VIDEO_HWACCEL not in ("", "none"):
+        return ["-hwaccel", VIDEO_HWACCEL]
+    return []
+
+def h264_filters(encoder, filters):
+    """Append the upload step hardware encoders need after software filters"""
+    if encoder == "h264_vaapi":
+        return filters + ["format=nv12", "hwupload"]
+    return filters
+
+def h264_quality_args(encoder, crf, preset=None):
+    """Map a libx264-style CRF value (and x264 preset) to the encoder's options"""
+    crf = str(crf)
+    if encoder == "h264_nvenc":
+        return ["-preset", "p4", "-rc", "vbr", "-cq", crf, "-b:v", "0"]
+    if encoder == "h264_qsv":
+        return ["-global_quality", crf]
+    if encoder == "h264_vaapi":
+        return ["-qp", crf]
+    if encoder == "h264_videotoolbox":
+        # -q:v runs 1-100 (higher is better); 23 -> 54, 18 -> 64, 28 -> 44
+        return ["-q:v", str(max(1, min(100, 100 - 2 * int(crf))))]
+    return ["-preset", preset or X264_PRESET, "-crf", crf]
+
+def _h264_encoder_works(encoder):
+    """Encode one tiny frame to confirm the encoder has usable hardware behind it"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-v", "error", *h264_input_args(encoder),
+        "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+    ]
+    filters = h264_filters(encoder, [])
+    if filters:
+        cmd.extend(["-vf", ",".join(filters)])
+    cmd.extend(["-frames:v", "1", "-c:v", encoder, "-f", "null", "-"])
+    try:
+        return run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=20).returncode == 0
+    except Exception:
+        return False
+
+@lru_cache(maxsize=1)
+def get_h264_encoder():
+    """Return the H.264 encoder to use, probing hardware encoders once per process"""
+    if VIDEO_ENCODER != "auto":
+        return VIDEO_ENCODER
+    try:
+        listing = run_cmd(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=20).stdout
+    except Exception as e:
+        logger.warning(f"Could not list ffmpeg encoders, using libx264: {e}")
+        return "libx264"
+    # being compiled in is not enough (e.g. nvenc without a GPU), so test each one
+    for encoder in HW_H264_ENCODERS:
+        if f" {encoder} " in listing and _h264_encoder_works(encoder):
+            logger.info(f"Using hardware H.264 encoder: {encoder}")
+            return encoder
+    logger.info("No hardware H.264 encoder available, using libx264")
+    return "libx264"
+
+def run_h264_ffmpeg(build_cmd):
+    """Run build_cmd(encoder) on the configured H.264 encoder; a hardware encoder can
+    still fail at runtime (e.g. session limit), so a failure is retried on libx264"""
+    encoder = get_h264_encoder()
+    encoders = [encoder] if encoder == "libx264" else [encoder, "libx264"]
+    for encoder in encoders:
+        r = run_ffmpeg(build_cmd(encoder))
+        if r.returncode == 0 or encoder == encoders[-1]:
+            return r
+        logger.warning(f"{encoder} encode failed, retrying on libx264: {r.stderr}")
+
+# Containers an H.264 video stream can be copied into, with the audio codecs each accepts
+REMUX_AUDIO_CODECS = {
+    "mp4": {"aac", "mp3"},
+    "mov": {"aac", "mp3"},
+    "mkv": {"aac", "mp3", "opus", "vorbis", "flac", "ac3"},
+}
+
+# Encoder options per audio output format and quality
+AUDIO_QUALITY_ARGS = {
+    "mp3": {"low": ("-b:a", "128k"), "medium": ("-b:a", "192k"), "high": ("-b:a", "320k")},
+    "aac": {"low": ("-b:a", "128k"), "medium": ("-b:a", "192k"), "high": ("-b:a", "256k")},
+    "ogg": {"low": ("-q:a", "3"), "medium": ("-q:a", "6"), "high": ("-q:a", "9")},
+    "opus": {"low": ("-b:a", "96k"), "medium": ("-b:a", "128k"), "high": ("-b:a", "192k")},
+}
+
+# Audio output formats and the source codecs that can be stream-copied into them
+COPY_AUDIO_CODECS = {
+    "mp3": {"mp3"},
+    "aac": {"aac"},
+    "m4a": {"aac", "alac"},
+    "ogg": {"vorbis", "opus"},
+    "opus": {"opus"},
+    "flac": {"flac"},
+    "wav": {"pcm_s16le"},
+}
+
+# How far a probe may read to find stream parameters (libavformat defaults: 5 MB / 5 s);
+# containers with headers (mp4, mkv, webm) are resolved long before either cap
+PROBE_OPTIONS = {"probesize": "2000000", "analyzeduration": "2000000"}
+
+def _run_ffprobe(path):
+    """Run ffprobe on path and return its raw JSON output"""
+    cmd = [
+        "ffprobe", "-v", "quiet", "-probesize", PROBE_OPTIONS["probesize"],
+        "-analyzeduration", PROBE_OPTIONS["analyzeduration"], "-print_format", "json",
+        "-show_format", "-show_streams", path,
+    ]
+    log_cmd("Running ffprobe command:", cmd)
+    try:
+        # raw bytes: the JSON parsers take bytes directly, no text decode pass
+        return run_cmd(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        e.stderr = (e.stderr or b"").decode("utf-8", "replace")
+        raise
+
+def _parse_ffprobe(output):
+    """Decode ffprobe JSON output"""
+    if orjson is not None:
+        return orjson.loads(output)  # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    return json.loads(output)
+
+def _probe_with_pyav(path):
+    """Read metadata in-process with PyAV, shaped like ffprobe's JSON output"""
+    with av.open(path, options=PROBE_OPTIONS) as container:
+        streams = []
+        for stream in container.streams:
+            codec = stream.codec_context
+            entry = {
+                "index": stream.index,
+                "codec_type": stream.type,
+                # canonical name matches ffprobe (e.g. "mp3", not the "mp3float" decoder)
+                "codec_name": codec.codec.canonical_name if codec else "",
+            }
+            if stream.type == "video":
+                rate = getattr(stream, "base_rate", None) or stream.average_rate
+                entry["width"] = codec.width
+                entry["height"] = codec.height
+                entry["pix_fmt"] = codec.format.name if codec.format else None
+                entry["profile"] = codec.profile
+                entry["r_frame_rate"] = f"{rate.numerator}/{rate.denominator}" if rate else "0/1"
+            elif stream.type == "audio":
+                entry["sample_rate"] = codec.sample_rate
+                entry["channels"] = len(codec.layout.channels)
+                entry["channel_layout"] = codec.layout.name
+            streams.append(entry)
+
+        format_info = {
+            "duration": container.duration / av.time_base if container.duration else 0,
+            "size": os.path.getsize(path),
+            "format_name": container.format.name,
+            "bit_rate": container.bit_rate or 0,
+        }
+    return {"streams": streams, "format": format_info}
+
+@lru_cache(maxsize=512)
+def _cached_probe(path, size, mtime_ns):
+    # size/mtime are part of the key so a rewritten file is probed again
+    if _PYAV_PROBE:
+        try:
+            return _probe_with_pyav(path)
+        except Exception as e:
+            logger.debug(f"PyAV probe failed for {path}, falling back to ffprobe: {e}")
+    return _parse_ffprobe(_run_ffprobe(path))
+
+# Per-file locks so concurrent first probes (e.g. /process screenshots and conversion
+# running side by side) share one probe instead of each missing the cache
+_probe_locks = {}
+_probe_locks_guard = threading.Lock()
+
+def probe_media(path):
+    """Return parsed ffprobe data for path, cached per (path, size, mtime).
+
+    The dict is shared between callers and threads; treat it as read-only.
+    """
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    with _probe_locks_guard:
+        lock = _probe_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            return _cached_probe(*key)
+    finally:
+        with _probe_locks_guard:
+            _probe_locks.pop(key, None)
+
 def log_startup_info():
     """Log startup information"""
     logger.info("=" * 60)
@@ -157,7 +585,8 @@ def log_startup_info():
     logger.info(f"Log directory: {os.getenv('LOG_DIR', './logs')}")
     logger.info(f"Flask debug mode: {os.getenv('FLASK_DEBUG', 'false')}")
     logger.info(f"Gunicorn workers: {os.getenv('GUNICORN_WORKERS', '4')}")
-    logger.info(f"Gunicorn worker class: {os.getenv('GUNICORN_WORKER_CLASS', 'sync')}")
+    logger.info(f"Gunicorn worker class: {os.getenv('GUNICORN_WORKER_CLASS', 'gthread')}")
+    logger.info(f"Gunicorn threads: {os.getenv('GUNICORN_THREADS', '8')}")
     logger.info(f"Gunicorn timeout: {os.getenv('GUNICORN_TIMEOUT', '120')}s")
     logger.info(f"Gunicorn max requests: {os.getenv('GUNICORN_MAX_REQUESTS', '1000')}")
     logger.info(f"Gunicorn max requests jitter: {os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '100')}")
@@ -169,19 +598,21 @@ def log_startup_info():
     logger.info(f"  MAX_FILE_SIZE: {MAX_FILE_SIZE} bytes ({MAX_FILE_SIZE/1024/1024:.1f} MB)")
     logger.info(f"  FILE_RETENTION_HOURS: {FILE_RETENTION_HOURS}")
     logger.info(f"  CLEANUP_INTERVAL_MINUTES: {CLEANUP_INTERVAL_MINUTES}")
-    logger.info(f"  ALLOWED_VIDEO_EXTENSIONS: {ALLOWED_VIDEO_EXTENSIONS}")
-    logger.info(f"  ALLOWED_AUDIO_EXTENSIONS: {ALLOWED_AUDIO_EXTENSIONS}")
-    logger.info(f"  SUPPORTED_VIDEO_OUTPUT_FORMATS: {SUPPORTED_VIDEO_OUTPUT_FORMATS}")
-    logger.info(f"  SUPPORTED_AUDIO_OUTPUT_FORMATS: {SUPPORTED_AUDIO_OUTPUT_FORMATS}")
+    logger.info(f"  ALLOWED_VIDEO_EXTENSIONS: {sorted(ALLOWED_VIDEO_EXTENSIONS)}")
+    logger.info(f"  ALLOWED_AUDIO_EXTENSIONS: {sorted(ALLOWED_AUDIO_EXTENSIONS)}")
+    logger.info(f"  SUPPORTED_VIDEO_OUTPUT_FORMATS: {sorted(SUPPORTED_VIDEO_OUTPUT_FORMATS)}")
+    logger.info(f"  SUPPORTED_AUDIO_OUTPUT_FORMATS: {sorted(SUPPORTED_AUDIO_OUTPUT_FORMATS)}")
     logger.info(f"  API_KEYS configured: {len(API_KEYS) > 0}")
     logger.info(f"  BASE_URL: {BASE_URL or 'Not set'}")
+    logger.info(f"  USE_X_SENDFILE: {USE_X_SENDFILE}")
+    logger.info(f"  X_ACCEL_REDIRECT: {X_ACCEL_REDIRECT or 'Not set'}")
 
 log_startup_info()
 
 def log_request_info(request_id=None):
     """Log request information with optional request ID (redact sensitive headers)"""
     if request_id is None:
-        request_id = str(uuid.uuid4())[:8]
+        request_id = token_hex(4)
     
     SENSITIVE_HEADERS = {"authorization", "x-api-key", "cookie", "set-cookie"}
     def _redact_headers(h):
@@ -194,6 +625,9 @@ def log_request_info(request_id=None):
             red[k] = "***REDACTED***" if k.lower() in SENSITIVE_HEADERS else v
         return red
 
+    if not logger.isEnabledFor(logging.INFO):
+        return request_id
+
     log_data = {
         "request_id": request_id,
         "method": request.method,
@@ -208,27 +642,35 @@ def log_request_info(request_id=None):
         "json": request.get_json(silent=True) if request.is_json else None,
     }
     
-    logger.info(f"Request {request_id}: {log_data}")
+    logger.info("Request %s: %s", request_id, log_data)
     return request_id
 
 
 def log_response_info(request_id, status_code, response_time=None, response_data=None):
     """Log response information"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
     log_data = {
         "request_id": request_id,
         "status_code": status_code,
         "response_time_ms": response_time,
         "response_data": response_data if response_data is not None else {},
     }
-    logger.info(f"Response {request_id}: {log_data}")
+    logger.info("Response %s: %s", request_id, log_data)
+
 
+def _short_err(error, limit=2048):
+    """str(error) capped at limit characters for responses and log lines (ffmpeg
+    failures embed stderr; the traceback still carries the full text)"""
+    message = str(error)
+    return message if len(message) <= limit else f"{message[:limit]}...(truncated)"
 
 def log_error(request_id, error, context=None):
     """Log error with context"""
     error_data = {
         "request_id": request_id,
         "error_type": type(error).__name__,
-        "error_message": str(error),
+        "error_message": _short_err(error),
         "context": context or {},
     }
     logger.error(f"Error {request_id}: {error_data}", exc_info=True)
@@ -261,20 +703,54 @@ def require_api_key(f):
     return decorated_function
 
 # --- safe magic helpers (lazy import; จะไม่ล่มถ้าไม่มี python-magic ติดตั้ง) ---
-def _safe_magic_from_file(path):
-    try:
-        import magic
-        return magic.from_file(path, mime=True)
-    except Exception:
-        return ""
+_magic = None
+_magic_lock = threading.Lock()
+
+def _get_magic():
+    """Shared magic.Magic(mime=True) so libmagic's database is loaded once"""
+    global _magic
+    if _magic is None:
+        with _magic_lock:
+            if _magic is None:
+                try:
+                    import magic
+                    _magic = magic.Magic(mime=True)
+                except Exception:
+                    _magic = False
+    return _magic or None
 
 def _safe_magic_from_buffer(buf):
     try:
-        import magic
-        return magic.from_buffer(buf, mime=True)
+        return _get_magic().from_buffer(buf)
     except Exception:
         return ""
 
+# Common container signatures, checked before falling back to libmagic: (offset, magic, mime)
+_MEDIA_SIGNATURES = (
+    (0, b"\x1a\x45\xdf\xa3", "video/x-matroska"),  # mkv / webm
+    (0, b"FLV", "video/x-flv"),
+    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", "video/x-ms-asf"),  # wmv / wma
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"OggS", "audio/ogg"),
+)
+
+def _sniff_media_mime(head):
+    """Cheap magic-byte check for common media containers ("" if unknown)"""
+    if head[4:8] == b"ftyp":
+        return "audio/mp4" if head[8:12] in (b"M4A ", b"M4B ") else "video/mp4"
+    if head[:4] == b"RIFF":
+        kind = head[8:12]
+        if kind == b"AVI ":
+            return "video/x-msvideo"
+        if kind == b"WAVE":
+            return "audio/x-wav"
+        return ""
+    for offset, magic_bytes, mime in _MEDIA_SIGNATURES:
+        if head[offset:offset + len(magic_bytes)] == magic_bytes:
+            return mime
+    return ""
+
 def _parse_bool(value):
     if isinstance(value, bool):
         return value
@@ -290,24 +766,41 @@ def _parse_int(value):
     except (ValueError, TypeError):
         return None
 
+def _parse_frame_rate(value):
+    """Parse an ffprobe rate such as "30000/1001" (or a plain number); 0 if invalid."""
+    num, _, den = str(value).partition("/")
+    try:
+        if not den:
+            return float(num)
+        den = float(den)
+        return float(num) / den if den else 0
+    except ValueError:
+        return 0
+
+_CSV_RE = re.compile(r"\s*,\s*")
+
+def _split_list(value):
+    """Items of a JSON array string or a CSV string; only a leading "[" is parsed as JSON,
+    so plain CSV never goes through a failing json.loads"""
+    value = value.strip()
+    if value.startswith("["):
+        return json.loads(value)
+    return [item for item in _CSV_RE.split(value) if item]
+
 def _parse_float_list(value):
     """Parse list of floats from JSON string, CSV string, or list."""
     if value is None:
         return None
+    if isinstance(value, str):
+        try:
+            value = _split_list(value)
+        except ValueError:
+            return None
     if isinstance(value, list):
         try:
             return [float(x) for x in value]
         except Exception:
             return None
-    if isinstance(value, str):
-        try:
-            arr = json.loads(value)
-            return [float(x) for x in arr]
-        except Exception:
-            try:
-                return [float(x.strip()) for x in value.split(",") if x.strip()]
-            except Exception:
-                return None
     return None
 
 def create_download_url(filename):
@@ -317,9 +810,21 @@ def create_download_url(filename):
         return f"{BASE_URL}{relative_url}"
     return relative_url
 
+def output_entry(path):
+    """{"filename", "url"} for an output file in TEMP_DIR"""
+    filename = os.path.basename(path)
+    return {"filename": filename, "url": create_download_url(filename)}
+
 def create_response(code=0, msg="", data=None):
     """Create standardized response"""
-    return jsonify({"code": code, "msg": msg, "data": data or {}})
+    body = {"code": code, "msg": msg, "data": data or {}}
+    if orjson is not None:
+        try:
+            return app.response_class(orjson.dumps(body), mimetype="application/json")
+        except TypeError:
+            pass  # e.g. non-str dict keys; let Flask's encoder handle it
+    return jsonify(body)
+
 class AudioProcessor:
     """Audio processing utility class"""
 
@@ -332,13 +837,7 @@ class AudioProcessor:
         """Extract audio metadata using ffprobe"""
         try:
             logger.info(f"Extracting audio info from: {self.audio_path}")
-            cmd = [
-                "ffprobe", "-v", "quiet", "-print_format", "json",
-                "-show_format", "-show_streams", self.audio_path,
-            ]
-            logger.debug(f"Running ffprobe command: {' '.join(cmd)}")
-            result = run_cmd(cmd, capture_output=True, text=True, check=True)
-            data = json.loads(result.stdout)
+            data = probe_media(self.audio_path)
 
             # Find audio stream
             audio_stream = None
@@ -364,7 +863,7 @@ class AudioProcessor:
                 "channel_layout": audio_stream.get("channel_layout", ""),
             }
 
-            logger.info(f"Audio info extracted successfully: {self.audio_info}")
+            logger.info("Audio info extracted successfully: %s", self.audio_info)
             return self.audio_info
 
         except subprocess.CalledProcessError as e:
@@ -383,37 +882,42 @@ class AudioProcessor:
             logger.info(f"Converting audio to {output_format} format with {quality} quality")
             if output_format not in SUPPORTED_AUDIO_OUTPUT_FORMATS:
                 logger.error(f"Unsupported audio output format: {output_format}")
-                raise ValueError(f"Unsupported output format. Supported: {SUPPORTED_AUDIO_OUTPUT_FORMATS}")
-
-            output_filename = f"converted_audio_{uuid.uuid4().hex}.{output_format}"
-            output_path = os.path.join(TEMP_DIR, output_filename)
-
-            # Quality settings for different formats
-            quality_settings = {
-                "mp3": {"low": ["-b:a", "128k"], "medium": ["-b:a", "192k"], "high": ["-b:a", "320k"]},
-                "aac": {"low": ["-b:a", "128k"], "medium": ["-b:a", "192k"], "high": ["-b:a", "256k"]},
-                "ogg": {"low": ["-q:a", "3"], "medium": ["-q:a", "6"], "high": ["-q:a", "9"]},
-                "opus": {"low": ["-b:a", "96k"], "medium": ["-b:a", "128k"], "high": ["-b:a", "192k"]},
-            }
-
-            # Base command
-            cmd = ["ffmpeg", "-i", self.audio_path]
-
-            # Add quality settings if available for the format
-            if output_format in quality_settings:
-                settings = quality_settings[output_format]
-                cmd.extend(settings.get(quality, settings["medium"]))
-            else:
-                # Default settings for other formats
-                cmd.extend(["-b:a", "192k"])
-
-            cmd.extend(["-y", output_path])
-
-            logger.debug(f"Running ffmpeg command: {' '.join(cmd)}")
-            result = run_cmd(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                logger.error(f"Audio conversion failed: {result.stderr}")
-                raise Exception(f"Conversion failed: {result.stderr}")
+                raise ValueError(f"Unsupported output format. Supported: {', '.join(sorted(SUPPORTED_AUDIO_OUTPUT_FORMATS))}")
+
+            output_filename = f"converted_audio_{token_hex(16)}.{output_format}"
+            output_path = new_temp_path(output_filename)
+
+            # source codec already matches the format: copy packets, encode only if that fails
+            modes = ["copy", "encode"] if quality == "medium" and self._can_copy(output_format) else ["encode"]
+
+            # output only shows up in TEMP_DIR once complete, so /download never serves a half-written file
+            with OutputFile(output_path, output_format) as out:
+                for mode in modes:
+                    # Base command
+                    cmd = ["ffmpeg", *ffmpeg_threads(), "-i", self.audio_path]
+
+                    if mode == "copy":
+                        cmd.extend(["-map", "0:a:0", "-c", "copy"])
+                    elif output_format in AUDIO_QUALITY_ARGS:
+                        # Add quality settings if available for the format
+                        settings = AUDIO_QUALITY_ARGS[output_format]
+                        cmd.extend(settings.get(quality, settings["medium"]))
+                    else:
+                        # Default settings for other formats
+                        cmd.extend(["-b:a", "192k"])
+
+                    cmd.extend(["-threads", str(FFMPEG_THREADS), "-y", *out.args])
+
+                    log_cmd("Running ffmpeg command:", cmd)
+                    result = run_ffmpeg(cmd, **out.run_kwargs)
+                    if result.returncode == 0:
+                        break
+                    if mode != modes[-1]:
+                        logger.warning(f"Stream copy failed, re-encoding: {result.stderr}")
+                        continue
+                    logger.error(f"Audio conversion failed: {result.stderr}")
+                    raise Exception(f"Conversion failed: {result.stderr}")
+                out.commit()
 
             file_size = os.path.getsize(output_path)
             logger.info(f"Audio conversion completed: {output_filename} ({file_size} bytes)")
@@ -430,6 +934,59 @@ class AudioProcessor:
             logger.error(f"Audio format conversion failed for {self.audio_path}: {str(e)}")
             raise Exception(f"Audio format conversion failed: {str(e)}")
 
+    def _can_copy(self, output_format):
+        """True when the audio stream can be copied into output_format without re-encoding"""
+        codecs = COPY_AUDIO_CODECS.get(output_format)
+        if codecs is None:
+            return False
+        try:
+            streams = probe_media(self.audio_path).get("streams", [])
+        except Exception as e:
+            logger.debug(f"Probe failed, not copying {self.audio_path}: {e}")
+            return False
+        audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        return audio is not None and audio.get("codec_name") in codecs
+
+
+# CRF per video conversion quality
+VIDEO_QUALITY_CRF = {"low": "28", "medium": "23", "high": "18"}
+
+# Common resolution presets accepted by _parse_resolution
+RESOLUTION_PRESETS = {
+    "240p": "426:240",
+    "360p": "640:360",
+    "480p": "854:480",
+    "720p": "1280:720",
+    "1080p": "1920:1080",
+    "1440p": "2560:1440",
+    "2160p": "3840:2160",  # 4K
+    "4k": "3840:2160",
+    "9:16": "1080:1920",
+    "9x16": "1080:1920",
+    "portrait": "1080:1920"
+}
+_RESOLUTION_RE = re.compile(r"^\s*(\d+)\s*[x:]\s*(\d+)\s*$")
+
+def screenshot_times(duration, timestamps=None, count=None):
+    """Timestamps to capture: the requested ones within duration (unknown duration keeps
+    them all), else count evenly spaced ones, else 25%, 50% and 75% of the video"""
+    if timestamps:
+        logger.info(f"Taking screenshots at specified timestamps: {timestamps}")
+        capture_at = []
+        for timestamp in timestamps:
+            if duration is not None and timestamp > duration:
+                logger.warning(f"Timestamp {timestamp}s exceeds video duration {duration}s")
+                continue
+            capture_at.append(timestamp)
+        return capture_at
+    if count:
+        logger.info(f"Taking {count} screenshots at evenly spaced intervals")
+        if count <= 0:
+            raise ValueError("Screenshot count must be positive")
+        interval = duration / (count + 1)
+        return [i * interval for i in range(1, count + 1)]
+    logger.info("Taking 3 default screenshots at 25%, 50%, 75% of video")
+    return [duration * i for i in [0.25, 0.5, 0.75]]
 
 class VideoProcessor:
     """Video processing utility class"""
@@ -443,13 +1000,7 @@ class VideoProcessor:
         """Extract video metadata using ffprobe"""
         try:
             logger.info(f"Extracting video info from: {self.video_path}")
-            cmd = [
-                "ffprobe", "-v", "quiet", "-print_format", "json",
-                "-show_format", "-show_streams", self.video_path,
-            ]
-            logger.debug(f"Running ffprobe command: {' '.join(cmd)}")
-            result = run_cmd(cmd, capture_output=True, text=True, check=True)
-            data = json.loads(result.stdout)
+            data = probe_media(self.video_path)
 
             # Find video stream
             video_stream = None
@@ -464,21 +1015,7 @@ class VideoProcessor:
 
             format_info = data.get("format", {})
 
-            # Calculate frame rate safely
-            frame_rate_str = video_stream.get("r_frame_rate", "0/1")
-            if "/" in str(frame_rate_str):
-                try:
-                    numerator, denominator = frame_rate_str.split("/")
-                    numerator = float(numerator)
-                    denominator = float(denominator)
-                    frame_rate = numerator / denominator if denominator != 0 else 0
-                except (ValueError, ZeroDivisionError):
-                    frame_rate = 0
-            else:
-                try:
-                    frame_rate = float(frame_rate_str)
-                except (ValueError, TypeError):
-                    frame_rate = 0
+            frame_rate = _parse_frame_rate(video_stream.get("r_frame_rate", "0/1"))
 
             self.video_info = {
                 "duration": float(format_info.get("duration", 0)),
@@ -491,7 +1028,7 @@ class VideoProcessor:
                 "bit_rate": int(format_info.get("bit_rate", 0)),
             }
 
-            logger.info(f"Video info extracted successfully: {self.video_info}")
+            logger.info("Video info extracted successfully: %s", self.video_info)
             return self.video_info
 
         except subprocess.CalledProcessError as e:
@@ -508,32 +1045,17 @@ class VideoProcessor:
         """Take screenshots from video"""
         try:
             logger.info(f"Taking screenshots from video: {self.video_path}")
-            if not self.video_info:
-                self.get_video_info()
-
-            duration = self.video_info["duration"]
-            screenshots = []
-
             if timestamps:
-                logger.info(f"Taking screenshots at specified timestamps: {timestamps}")
-                for timestamp in timestamps:
-                    if timestamp > duration:
-                        logger.warning(f"Timestamp {timestamp}s exceeds video duration {duration}s")
-                        continue
-                    screenshots.append(self._capture_screenshot(timestamp))
-            elif count:
-                logger.info(f"Taking {count} screenshots at evenly spaced intervals")
-                if count <= 0:
-                    raise ValueError("Screenshot count must be positive")
-                interval = duration / (count + 1)
-                for i in range(1, count + 1):
-                    timestamp = i * interval
-                    screenshots.append(self._capture_screenshot(timestamp))
+                # no probe needed: ffmpeg writes nothing for a seek past the end,
+                # and _capture_screenshots drops those timestamps
+                duration = self.video_info["duration"] if self.video_info else None
             else:
-                logger.info("Taking 3 default screenshots at 25%, 50%, 75% of video")
-                for i in [0.25, 0.5, 0.75]:
-                    timestamp = duration * i
-                    screenshots.append(self._capture_screenshot(timestamp))
+                if not self.video_info:
+                    self.get_video_info()
+                duration = self.video_info["duration"]
+            capture_at = screenshot_times(duration, timestamps, count)
+
+            screenshots = self._capture_screenshots(capture_at)
 
             logger.info(f"Screenshot capture completed: {len(screenshots)} screenshots taken")
             return screenshots
@@ -542,23 +1064,140 @@ class VideoProcessor:
             logger.error(f"Screenshot capture failed for {self.video_path}: {str(e)}")
             raise Exception(f"Screenshot capture failed: {str(e)}")
 
+    def _capture_screenshots(self, timestamps):
+        """Capture several screenshots in one ffmpeg process, one input-seeked decoder per timestamp"""
+        if not timestamps:
+            return []
+        if _PYAV_FRAME_ROTATION:
+            try:
+                return self._capture_screenshots_pyav(timestamps)
+            except Exception as e:
+                logger.debug(f"In-process screenshot capture unavailable, using ffmpeg: {e}")
+        if len(timestamps) == 1:
+            shot = self._capture_screenshot(timestamps[0])
+            return [shot] if shot else []
+
+        # one input-seeked input and one output clause per timestamp, all in one process
+        order = sorted(range(len(timestamps)), key=lambda idx: timestamps[idx])
+        shots = [None] * len(timestamps)
+        cmd = ["ffmpeg", "-y"]
+        for idx in order:
+            # one-frame grabs are latency-bound; extra decoder threads only add startup
+            cmd.extend(["-ss", str(timestamps[idx]), *ffmpeg_threads(1), "-i", self.video_path])
+        for input_idx, idx in enumerate(order):
+            timestamp = timestamps[idx]
+            output_filename = f"screenshot_{token_hex(16)}_{int(timestamp)}.jpg"
+            output_path = new_temp_path(output_filename)
+            cmd.extend(["-map", f"{input_idx}:v:0", "-frames:v", "1", "-q:v", "2", output_path])
+            shots[idx] = {
+                "timestamp": timestamp,
+                "filename": output_filename,
+                "file_path": output_path,
+            }
+
+        log_cmd("Running ffmpeg multi-screenshot command:", cmd)
+        r = run_ffmpeg(cmd)
+        try:
+            if r.returncode != 0:
+                logger.error(f"Screenshots failed at {timestamps}: {r.stderr}")
+                raise Exception(f"Screenshot failed: {r.stderr}")
+            captured = []
+            for shot in shots:
+                if not os.path.exists(shot["file_path"]):
+                    logger.warning(f"Timestamp {shot['timestamp']}s is past the end of the video, skipped")
+                    continue
+                shot["file_size"] = os.path.getsize(shot["file_path"])
+                shot["url"] = create_download_url(shot["filename"])
+                captured.append(shot)
+        except Exception:
+            cleanup_temp_files(*[s["file_path"] for s in shots])
+            raise
+        shots = captured
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Screenshots captured successfully: %s", [s["filename"] for s in shots])
+        return shots
+
+    def _capture_screenshots_pyav(self, timestamps):
+        """Grab and JPEG-encode frames in-process with PyAV (no ffmpeg launch per call)"""
+        shots = {}
+        try:
+            with _ffmpeg_sem, av.open(self.video_path) as container:
+                stream = container.streams.video[0]
+                stream.thread_type = "AUTO"
+                # -ss is relative to the start of the file, frame.time is not
+                start = container.start_time / av.time_base if container.start_time else 0
+                for idx in sorted(range(len(timestamps)), key=lambda i: timestamps[i]):
+                    timestamp = timestamps[idx]
+                    target = start + timestamp
+                    container.seek(int(target / stream.time_base), stream=stream)
+                    frame = next(
+                        (f for f in container.decode(stream) if f.time is not None and f.time >= target - 1e-3),
+                        None,
+                    )
+                    if frame is None:
+                        logger.warning(f"Timestamp {timestamp}s is past the end of the video, skipped")
+                        continue
+                    # ffmpeg applies the display matrix; leave rotated sources to it
+                    if frame.rotation != 0:
+                        raise ValueError("rotated video")
+
+                    fmt = frame.format.name
+                    pix_fmt = "yuvj444p" if "444" in fmt else "yuvj422p" if "422" in fmt else "yuvj420p"
+                    encoder = av.CodecContext.create("mjpeg", "w")
+                    encoder.width = frame.width
+                    encoder.height = frame.height
+                    encoder.pix_fmt = pix_fmt
+                    encoder.time_base = stream.time_base
+                    encoder.qscale = True
+                    encoder.global_quality = 2 * 118  # -q:v 2 (FF_QP2LAMBDA = 118)
+
+                    output_filename = f"screenshot_{token_hex(16)}_{int(timestamp)}.jpg"
+                    output_path = new_temp_path(output_filename)
+                    shots[idx] = {
+                        "timestamp": timestamp,
+                        "filename": output_filename,
+                        "file_path": output_path,
+                    }
+                    # written beside the final name, so a failed encode is never served
+                    with open(partial_path(output_path), "wb") as f:
+                        for packet in encoder.encode(frame.reformat(format=pix_fmt)):
+                            f.write(bytes(packet))
+                    os.replace(partial_path(output_path), output_path)
+                    shots[idx]["file_size"] = os.path.getsize(output_path)
+                    shots[idx]["url"] = create_download_url(output_filename)
+        except Exception:
+            # the ffmpeg fallback starts over: drop finished shots and the one in progress
+            cleanup_temp_files(*[
+                path for shot in shots.values() for path in (shot["file_path"], partial_path(shot["file_path"]))
+            ])
+            raise
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Screenshots captured in-process: %s", [shot["filename"] for shot in shots.values()])
+        return [shots[idx] for idx in sorted(shots)]
+
     def _capture_screenshot(self, timestamp):
-        """Capture a single screenshot at specified timestamp"""
-        output_filename = f"screenshot_{uuid.uuid4().hex}_{int(timestamp)}.jpg"
-        output_path = os.path.join(TEMP_DIR, output_filename)
+        """Capture a single screenshot at specified timestamp (None if past the end)"""
+        output_filename = f"screenshot_{token_hex(16)}_{int(timestamp)}.jpg"
+        output_path = new_temp_path(output_filename)
 
         logger.debug(f"Capturing screenshot at {timestamp}s: {output_filename}")
 
+        # -ss before -i seeks in the demuxer instead of decoding up to the timestamp
         cmd = [
-            "ffmpeg", "-i", self.video_path, "-ss", str(timestamp),
-            "-vframes", "1", "-q:v", "2", "-y", output_path,
+            "ffmpeg", "-ss", str(timestamp), *ffmpeg_threads(1), "-i", self.video_path,
+            "-frames:v", "1", "-q:v", "2", "-y", output_path,
         ]
 
-        logger.debug(f"Running ffmpeg screenshot command: {' '.join(cmd)}")
-        r = run_cmd(cmd, capture_output=True, text=True)
+        log_cmd("Running ffmpeg screenshot command:", cmd)
+        r = run_ffmpeg(cmd)
         if r.returncode != 0:
             logger.error(f"Screenshot failed at {timestamp}s: {r.stderr}")
             raise Exception(f"Screenshot failed: {r.stderr}")
+        if not os.path.exists(output_path):
+            logger.warning(f"Timestamp {timestamp}s is past the end of the video, skipped")
+            return None
 
         file_size = os.path.getsize(output_path)
         logger.debug(f"Screenshot captured successfully: {output_filename} ({file_size} bytes)")
@@ -573,96 +1212,135 @@ class VideoProcessor:
 
     def convert_format(self, output_format, quality="medium", resolution=None):
         """Convert video to specified format with optional resolution"""
-        try:
-            logger.info(f"Converting video to {output_format} format with {quality} quality")
-            if resolution:
-                logger.info(f"Resolution scaling: {resolution}")
-            if output_format not in SUPPORTED_VIDEO_OUTPUT_FORMATS:
-                logger.error(f"Unsupported video output format: {output_format}")
-                raise ValueError(f"Unsupported output format. Supported: {SUPPORTED_VIDEO_OUTPUT_FORMATS}")
-
-            output_filename = f"converted_{uuid.uuid4().hex}.{output_format}"
-            output_path = os.path.join(TEMP_DIR, output_filename)
-
-            quality_settings = {"low": ["-crf", "28"], "medium": ["-crf", "23"], "high": ["-crf", "18"]}
-
-            cmd = [
-                "ffmpeg", "-i", self.video_path, "-c:v", "libx264", "-c:a", "aac",
-                *quality_settings.get(quality, quality_settings["medium"]),
-            ]
-            if resolution:
-                resolution_str = self._parse_resolution(resolution)
-                cmd.extend(["-vf", f"scale={resolution_str}"])
-
-            cmd.extend(["-y", output_path])
-
-            logger.debug(f"Running ffmpeg conversion command: {' '.join(cmd)}")
-            r = run_cmd(cmd, capture_output=True, text=True)
-            if r.returncode != 0:
-                logger.error(f"Video conversion failed: {r.stderr}")
-                raise Exception(f"Conversion failed: {r.stderr}")
+        return self.convert_formats([(output_format, quality, resolution)])[0]
 
-            file_size = os.path.getsize(output_path)
-            logger.info(f"Video conversion completed: {output_filename} ({file_size} bytes)")
+    def convert_formats(self, specs):
+        """Convert video to several (format, quality, resolution) renditions in one ffmpeg run.
 
-            return {
-                "filename": output_filename,
-                "file_path": output_path,
-                "file_size": file_size,
-                "format": output_format,
-                "resolution": resolution if resolution else "original",
-                "url": create_download_url(output_filename),
-            }
+        Every rendition is an output of the same command, so the source is read and
+        decoded once however many renditions are requested.
+        """
+        try:
+            for output_format, quality, resolution in specs:
+                logger.info(f"Converting video to {output_format} format with {quality} quality")
+                if resolution:
+                    logger.info(f"Resolution scaling: {resolution}")
+                if output_format not in SUPPORTED_VIDEO_OUTPUT_FORMATS:
+                    logger.error(f"Unsupported video output format: {output_format}")
+                    raise ValueError(f"Unsupported output format. Supported: {', '.join(sorted(SUPPORTED_VIDEO_OUTPUT_FORMATS))}")
+
+            renditions = []
+            for output_format, quality, resolution in specs:
+                output_filename = f"converted_{token_hex(16)}.{output_format}"
+                filters = []
+                if resolution:
+                    resolution_str = self._parse_resolution(resolution)
+                    filters.append(f"scale={resolution_str}")
+                renditions.append({
+                    "filename": output_filename,
+                    "path": new_temp_path(output_filename),
+                    "format": output_format,
+                    "resolution": resolution,
+                    "crf": VIDEO_QUALITY_CRF.get(quality, VIDEO_QUALITY_CRF["medium"]),
+                    "filters": filters,
+                    # streams already fit the container: copy packets, encode only if that fails
+                    "remux": not resolution and quality == "medium" and self._can_remux(output_format),
+                })
+
+            encoder = get_h264_encoder()
+            # a hardware encoder can still fail at runtime (e.g. session limit), so retry on libx264
+            encoders = [encoder] if encoder == "libx264" else [encoder, "libx264"]
+            attempts = [(encoder, False) for encoder in encoders]
+            if any(rend["remux"] for rend in renditions):
+                # first try copying the renditions that allow it, encoding only the rest
+                attempts.insert(0, (encoders[0], True))
+            # outputs only show up in TEMP_DIR once complete, so /download never serves a half-written file
+            with ExitStack() as stack:
+                outs = [stack.enter_context(OutputFile(rend["path"], rend["format"])) for rend in renditions]
+                pass_fds = tuple(fd for out in outs for fd in out.run_kwargs.get("pass_fds", ()))
+                run_kwargs = {"pass_fds": pass_fds} if pass_fds else {}
+                for encoder, copy in attempts:
+                    encoding = not (copy and all(rend["remux"] for rend in renditions))
+                    cmd = ["ffmpeg"]
+                    if encoding:
+                        cmd.extend([*h264_input_args(encoder), *h264_decode_args(encoder)])
+                    cmd.extend([*ffmpeg_threads(), "-i", self.video_path, "-y"])
+                    for rend, out in zip(renditions, outs):
+                        if copy and rend["remux"]:
+                            cmd.extend(["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"])
+                        else:
+                            cmd.extend(["-c:v", encoder, "-c:a", "aac", *h264_quality_args(encoder, rend["crf"])])
+                            encoder_filters = h264_filters(encoder, rend["filters"])
+                            if encoder_filters:
+                                cmd.extend(["-vf", ",".join(encoder_filters)])
+                        if rend["format"] in ("mp4", "mov"):
+                            # moov atom up front so downloads can start playing immediately
+                            cmd.extend(["-movflags", "+faststart"])
+                        cmd.extend(["-threads", str(FFMPEG_THREADS), *out.args])
+
+                    log_cmd("Running ffmpeg conversion command:", cmd)
+                    r = run_ffmpeg(cmd, **run_kwargs)
+                    if r.returncode == 0:
+                        break
+                    if (encoder, copy) != attempts[-1]:
+                        logger.warning(f"{encoder if encoding else 'copy'} conversion failed, trying the next encoder: {r.stderr}")
+                        continue
+                    logger.error(f"Video conversion failed: {r.stderr}")
+                    raise Exception(f"Conversion failed: {r.stderr}")
+                for out in outs:
+                    out.commit()
+
+            results = []
+            for rend in renditions:
+                file_size = os.path.getsize(rend["path"])
+                logger.info(f"Video conversion completed: {rend['filename']} ({file_size} bytes)")
+                results.append({
+                    "filename": rend["filename"],
+                    "file_path": rend["path"],
+                    "file_size": file_size,
+                    "format": rend["format"],
+                    "resolution": rend["resolution"] if rend["resolution"] else "original",
+                    "url": create_download_url(rend["filename"]),
+                })
+            return results
 
         except Exception as e:
             logger.error(f"Video format conversion failed for {self.video_path}: {str(e)}")
             raise Exception(f"Format conversion failed: {str(e)}")
 
-    def _parse_resolution(self, resolution):
+    def _can_remux(self, output_format):
+        """True when the streams can be copied into output_format without re-encoding"""
+        audio_codecs = REMUX_AUDIO_CODECS.get(output_format)
+        if audio_codecs is None:
+            return False
+        try:
+            streams = probe_media(self.video_path).get("streams", [])
+        except Exception as e:
+            logger.debug(f"Probe failed, not remuxing {self.video_path}: {e}")
+            return False
+        video = next((s for s in streams if s.get("codec_type") == "video"), None)
+        audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        if not video or video.get("codec_name") != "h264":
+            return False
+        return audio is None or audio.get("codec_name") in audio_codecs
+
+    @staticmethod
+    def _parse_resolution(resolution):
         """Parse and validate resolution parameter"""
         if not resolution:
             return None
 
-        # Handle common resolution presets
-        resolution_presets = {
-            "240p": "426:240",
-            "360p": "640:360",
-            "480p": "854:480",
-            "720p": "1280:720",
-            "1080p": "1920:1080",
-            "1440p": "2560:1440",
-            "2160p": "3840:2160",  # 4K
-            "4k": "3840:2160",
-            "9:16": "1080:1920",
-            "9x16": "1080:1920",
-            "portrait": "1080:1920"
-        }
-
-        resolution_lower = str(resolution).lower()
-        if resolution_lower in resolution_presets:
-            return resolution_presets[resolution_lower]
-
-        # Handle custom resolution formats
-        resolution_str = str(resolution)
-        if 'x' in resolution_str:
-            parts = resolution_str.split('x')
-            if len(parts) == 2:
-                try:
-                    width = int(parts[0]); height = int(parts[1])
-                    if (width > 0 and height > 0 and width <= 7680 and height <= 4320):
-                        return f"{width}:{height}"
-                except ValueError:
-                    pass
+        resolution_str = str(resolution).lower()
+        preset = RESOLUTION_PRESETS.get(resolution_str)
+        if preset:
+            return preset
 
-        if ':' in resolution_str:
-            parts = resolution_str.split(':')
-            if len(parts) == 2:
-                try:
-                    width = int(parts[0]); height = int(parts[1])
-                    if (width > 0 and height > 0 and width <= 7680 and height <= 4320):
-                        return f"{width}:{height}"
-                except ValueError:
-                    pass
+        # Handle custom resolution formats (WxH or W:H)
+        m = _RESOLUTION_RE.match(resolution_str)
+        if m:
+            width, height = int(m.group(1)), int(m.group(2))
+            if 0 < width <= 7680 and 0 < height <= 4320:
+                return f"{width}:{height}"
 
         try:
             dimension = int(resolution_str)
@@ -677,7 +1355,171 @@ class VideoProcessor:
         )
 
 
+class _LimitedReader(io.RawIOBase):
+    """Readable wrapper that counts bytes and raises once limit is exceeded"""
+
+    def __init__(self, raw, limit):
+        self._raw = raw
+        self._limit = limit
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # hand the chunk straight through; RawIOBase.read would copy it twice via readinto
+        data = self._raw.read(None if size is None or size < 0 else size)
+        self.bytes_read += len(data)
+        if self.bytes_read > self._limit:
+            logger.error(f"Downloaded file too large: {self.bytes_read} bytes")
+            raise ValueError("File too large")
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+
+def _preallocate(fd, size):
+    """Reserve size bytes for fd up front so the filesystem allocates extents once"""
+    if not size or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        logger.debug(f"posix_fallocate not supported here: {e}")
+
+
+class _InflightDownload:
+    """A URL download other requests can wait on instead of fetching it again"""
+
+    def __init__(self):
+        self.future = Future()
+        self.followers = 0
+        self.linked = threading.Semaphore(0)
+
+
+_inflight_downloads = {}
+_inflight_lock = threading.Lock()
+
+
 def download_media_from_url(url):
+    """Download media file (video or audio) from URL
+
+    Concurrent requests for the same URL share one transfer: the first caller
+    downloads, the others get a hard link (or copy) of its file once it lands.
+    """
+    with _inflight_lock:
+        entry = _inflight_downloads.get(url)
+        if entry is None:
+            entry = _inflight_downloads[url] = _InflightDownload()
+            owner = True
+        else:
+            entry.followers += 1
+            owner = False
+
+    if not owner:
+        try:
+            source = entry.future.result()
+            logger.info(f"Reusing in-flight download of {url}")
+            return _link_temp_copy(source, f"input_{token_hex(16)}")
+        finally:
+            entry.linked.release()
+
+    try:
+        path = _fetch_media_from_url(url)
+    except Exception as e:
+        with _inflight_lock:
+            del _inflight_downloads[url]
+        entry.future.set_exception(e)
+        raise
+    with _inflight_lock:
+        del _inflight_downloads[url]
+        followers = entry.followers
+    entry.future.set_result(path)
+    # our caller may delete the file as soon as we return; let followers link it first
+    for _ in range(followers):
+        entry.linked.acquire()
+    return path
+
+
+def download_media_from_urls(urls):
+    """Download several URLs side by side; returns the local paths in input order.
+
+    If any download fails the others' files are removed and the first error is raised.
+    """
+    if len(urls) < 2:
+        return [download_media_from_url(url) for url in urls]
+    futures = [_download_executor.submit(download_media_from_url, url) for url in urls]
+    wait(futures)
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        cleanup_temp_files(*(f.result() for f in futures if f.exception() is None))
+        raise errors[0]
+    return [f.result() for f in futures]
+
+
+def _link_temp_copy(source, filename):
+    """Give a temp file a second name (hard link, or a copy across filesystems)"""
+    dest = new_temp_path(filename)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+    return dest
+
+
+def _url_cache_meta_path(url):
+    return os.path.join(TEMP_DIR, f"cache_{blake2b(url.encode(), digest_size=16).hexdigest()}.json")
+
+
+def _load_url_cache(url):
+    """Validators and file of the cached download of url, or None"""
+    try:
+        with open(_url_cache_meta_path(url)) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta.get("url") != url or not os.path.isfile(os.path.join(TEMP_DIR, meta.get("file", ""))):
+        return None
+    return meta
+
+
+def _store_url_cache(url, response, path):
+    """Keep a hard link of a finished download if the server sent validators for it"""
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not (etag or last_modified):
+        return
+    # one file per URL version, so the metadata swap below is the only switch-over
+    version = blake2b(f"{url}\n{etag}\n{last_modified}".encode(), digest_size=16).hexdigest()
+    name = f"cache_{version}"
+    meta_path = _url_cache_meta_path(url)
+    tmp_path = f"{meta_path}.{local_temp_id()}.tmp"
+    try:
+        try:
+            os.link(path, os.path.join(TEMP_DIR, name))
+        except FileExistsError:
+            pass
+        with open(tmp_path, "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "file": name}, f)
+        os.replace(tmp_path, meta_path)
+    except OSError as e:
+        cleanup_temp_files(tmp_path)
+        logger.debug(f"Could not cache download of {url}: {e}")
+
+
+def _reuse_url_cache(meta):
+    """Link a fresh input_ name to a revalidated cache entry and mark it recently used"""
+    source = os.path.join(TEMP_DIR, meta["file"])
+    for path in (source, _url_cache_meta_path(meta["url"])):
+        os.utime(path)
+    return _link_temp_copy(source, f"input_{token_hex(16)}")
+
+
+def _fetch_media_from_url(url, use_cache=URL_CACHE):
     """Download media file (video or audio) from URL"""
     try:
         logger.info(f"Downloading media from URL: {url}")
@@ -686,38 +1528,57 @@ def download_media_from_url(url):
             logger.error(f"Invalid URL format: {url}")
             raise ValueError("Invalid URL")
 
-        temp_filename = f"input_{uuid.uuid4().hex}"
-        temp_path = os.path.join(TEMP_DIR, temp_filename)
-        logger.debug(f"Created temp file: {temp_path}")
+        # revalidate an earlier download instead of fetching the body again
+        cached = _load_url_cache(url) if use_cache else None
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
 
         logger.debug(f"Starting download from: {url}")
-        response = requests.get(url, stream=True, timeout=30)
-        response.raise_for_status()
-
-        content_type = response.headers.get("content-type", "").lower()
-        media_types = ["video", "audio", "application/octet-stream"]
-        if not any(media_type in content_type for media_type in media_types):
-            logger.warning(f"Content type '{content_type}' may not be a media file")
-
-        content_length = response.headers.get("content-length")
-        if content_length:
-            file_size = int(content_length)
-            logger.info(f"Expected file size: {file_size} bytes ({file_size/1024/1024:.1f} MB)")
-            if file_size > MAX_FILE_SIZE:
-                logger.error(f"File too large: {file_size} bytes > {MAX_FILE_SIZE} bytes")
-                raise ValueError("File too large")
-
-        logger.debug("Starting file download...")
-        with open(temp_path, "wb") as f:
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if downloaded > MAX_FILE_SIZE:
-                        os.remove(temp_path)
-                        logger.error(f"Downloaded file too large: {downloaded} bytes")
-                        raise ValueError("File too large")
+        # pooled keep-alive session; closing the response returns the connection
+        with _http.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+            if cached and response.status_code == 304:
+                try:
+                    path = _reuse_url_cache(cached)
+                except FileNotFoundError:
+                    # swept between the lookup and now
+                    return _fetch_media_from_url(url, use_cache=False)
+                logger.info(f"URL unchanged, reusing cached download: {path}")
+                return path
+            response.raise_for_status()
+
+            temp_filename = f"input_{token_hex(16)}"
+            temp_path = new_temp_path(temp_filename)
+            logger.debug(f"Created temp file: {temp_path}")
+
+            content_type = response.headers.get("content-type", "").lower()
+            media_types = ["video", "audio", "application/octet-stream"]
+            if not any(media_type in content_type for media_type in media_types):
+                logger.warning(f"Content type '{content_type}' may not be a media file")
+
+            content_length = response.headers.get("content-length")
+            file_size = None
+            if content_length:
+                file_size = int(content_length)
+                logger.info(f"Expected file size: {file_size} bytes ({file_size/1024/1024:.1f} MB)")
+                if file_size > MAX_FILE_SIZE:
+                    logger.error(f"File too large: {file_size} bytes > {MAX_FILE_SIZE} bytes")
+                    raise ValueError("File too large")
+
+            logger.debug("Starting file download...")
+            response.raw.decode_content = True
+            reader = _LimitedReader(response.raw, MAX_FILE_SIZE)
+            with open(temp_path, "wb", buffering=IO_BUFFER_SIZE) as f:
+                _preallocate(f.fileno(), file_size)
+                shutil.copyfileobj(reader, f, length=IO_BUFFER_SIZE)
+                # drop any preallocated tail if the body was shorter than announced
+                f.truncate()
+            downloaded = reader.bytes_read
+            if use_cache:
+                _store_url_cache(url, response, temp_path)
 
         logger.info(f"Download completed: {temp_path} ({downloaded} bytes)")
         return temp_path
@@ -743,8 +1604,10 @@ def detect_media_type(file_path):
         if file_ext in ALLOWED_AUDIO_EXTENSIONS:
             return "audio"
 
-        # fallback to magic (if available)
-        mime_type = _safe_magic_from_file(file_path) or ""
+        # fallback to the header: signature table, then magic (if available)
+        with open(file_path, "rb") as fh:
+            head = fh.read(1024)
+        mime_type = _sniff_media_mime(head) or _safe_magic_from_buffer(head) or ""
         if mime_type.startswith("video/"):
             return "video"
         if mime_type.startswith("audio/"):
@@ -770,34 +1633,44 @@ def save_uploaded_file(file):
     """Save uploaded file"""
     try:
         logger.info(f"Saving uploaded file: {file.filename}")
-        file.seek(0, 2)  # to end
-        file_size = file.tell()
-        file.seek(0)
-
-        logger.info(f"Uploaded file size: {file_size} bytes ({file_size/1024/1024:.1f} MB)")
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"Uploaded file too large: {file_size} bytes > {MAX_FILE_SIZE} bytes")
+        # MAX_CONTENT_LENGTH caps the whole body, so a declared Content-Length already
+        # bounds this file; only chunked uploads need the seek-to-end measurement
+        if request.content_length is None:
+            file.seek(0, 2)  # to end
+            file_size = file.tell()
+            file.seek(0)
+            if file_size > MAX_FILE_SIZE:
+                logger.error(f"Uploaded file too large: {file_size} bytes > {MAX_FILE_SIZE} bytes")
+                raise ValueError("File too large")
+        elif request.content_length > MAX_FILE_SIZE:
+            logger.error(f"Upload body too large: {request.content_length} bytes > {MAX_FILE_SIZE} bytes")
             raise ValueError("File too large")
 
-        filename = file.filename or ""
-        file_ext = os.path.splitext(filename)[1].lower()
+        filename = (file.filename or "").lower()
+        file_ext = os.path.splitext(filename)[1]
         logger.debug(f"File extension: {file_ext}")
 
-        if (file_ext not in ALLOWED_VIDEO_EXTENSIONS and file_ext not in ALLOWED_AUDIO_EXTENSIONS):
+        if not filename.endswith(_ALLOWED_MEDIA_SUFFIXES):
             logger.warning(f"Unsupported file extension: {file_ext}")
-            # Try to detect file type using magic (safe)
-            file_content = file.read(1024)
-            file.seek(0)
-            mime_type = _safe_magic_from_buffer(file_content) or ""
+            # Try to detect file type using magic (safe); disk-spooled uploads are buffered
+            # readers, so peek at the header instead of reading and seeking back
+            peek = getattr(file.stream, "peek", None)
+            if peek is not None:
+                file_content = peek(1024)[:1024]
+            else:
+                file_content = file.read(1024)
+                file.seek(0)
+            mime_type = _sniff_media_mime(file_content) or _safe_magic_from_buffer(file_content) or ""
             logger.debug(f"Detected MIME type: {mime_type}")
             if not (mime_type.startswith("video/") or mime_type.startswith("audio/")):
                 logger.error(f"Invalid file type: {mime_type or 'unknown'}")
                 raise ValueError("Not a valid video or audio file")
 
-        temp_filename = f"upload_{uuid.uuid4().hex}{file_ext}"
-        temp_path = os.path.join(TEMP_DIR, temp_filename)
-        file.save(temp_path)
-        logger.info(f"File saved successfully: {temp_path}")
+        temp_filename = f"upload_{token_hex(16)}{file_ext}"
+        temp_path = new_temp_path(temp_filename)
+        file_size = save_stream(file.stream, temp_path)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"File saved successfully: {temp_path} ({file_size} bytes, {file_size/1024/1024:.1f} MB)")
         return temp_path
 
     except Exception as e:
@@ -808,127 +1681,830 @@ def save_uploaded_file(file):
 def cleanup_temp_files(*file_paths):
     """Clean up temporary files"""
     for file_path in file_paths:
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logger.debug(f"Cleaned up temp file: {file_path}")
-            except Exception as e:
-                logger.warning(f"Failed to clean up temp file {file_path}: {e}")
-                pass
-def cleanup_old_files():
-    """Clean up files older than FILE_RETENTION_HOURS"""
+        if not file_path:
+            continue
+        try:
+            os.unlink(file_path)
+            logger.debug(f"Cleaned up temp file: {file_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to clean up temp file {file_path}: {e}")
+
+
+# Expiry schedule for files this process created: min-heap of (expire_at, path)
+_expiry_heap = []
+_expiry_cond = threading.Condition()
+
+
+_temp_counter = itertools.count()
+
+def local_temp_id():
+    """Unique id for a temp file that is never handed out (pid, per-process counter, ms
+    clock); served names need token_hex, since /download only checks the name"""
+    return f"{os.getpid()}_{next(_temp_counter):x}_{int(time.time() * 1000):x}"
+
+def new_temp_path(filename):
+    """Return the TEMP_DIR path for filename and schedule it for expiry"""
+    path = os.path.join(TEMP_DIR, filename)
+    expire_at = time.time() + FILE_RETENTION_HOURS * 3600
+    with _expiry_cond:
+        heapq.heappush(_expiry_heap, (expire_at, path))
+        if _expiry_heap[0][1] == path:
+            # new earliest deadline, wake the cleanup worker to re-arm its timer
+            _expiry_cond.notify()
+    return path
+
+
+def partial_path(path):
+    """Sibling path ffmpeg writes to before the result is renamed onto path (keeps the extension for muxer detection)"""
+    head, tail = os.path.split(path)
+    return os.path.join(head, f"part_{tail}")
+
+
+# ffmpeg muxer per output extension, needed when writing to an unnamed file
+_FFMPEG_MUXERS = {
+    "mp4": "mp4", "m4v": "mp4", "mov": "mov", "mkv": "matroska", "webm": "webm", "avi": "avi", "flv": "flv",
+    "mp3": "mp3", "wav": "wav", "flac": "flac", "aac": "adts", "m4a": "ipod", "ogg": "ogg", "opus": "opus",
+}
+_O_TMPFILE = getattr(os, "O_TMPFILE", 0)
+
+
+def open_unnamed_temp(flags=os.O_RDWR):
+    """fd of a new unnamed (O_TMPFILE) inode in TEMP_DIR, or None where unsupported"""
+    if _temp_dir_fd is None:
+        return None
     try:
-        if not os.path.exists(TEMP_DIR):
-            logger.debug("Temp directory does not exist, skipping cleanup")
-            return
+        return os.open(".", _O_TMPFILE | flags, 0o644, dir_fd=_temp_dir_fd)
+    except OSError:
+        # filesystem without O_TMPFILE support
+        return None
+
+
+def link_unnamed_temp(fd, path):
+    """Give an open_unnamed_temp() inode its name in TEMP_DIR"""
+    # a dir_fd makes os.link use linkat(AT_SYMLINK_FOLLOW), which resolves the /proc link to the inode
+    os.link(f"/proc/self/fd/{fd}", os.path.basename(path), dst_dir_fd=_temp_dir_fd)
+
+
+def _stream_fd(stream):
+    """(fd, offset) when stream is backed by a real file, else None (copyfileobj path)"""
+    # only public API: in-memory streams (BytesIO) raise here; a small SpooledTemporaryFile
+    # upload rolls over to disk instead, which costs at most its spool size
+    try:
+        return stream.fileno(), stream.tell()
+    except (io.UnsupportedOperation, AttributeError, OSError):
+        return None
+
+
+def _sendfile_all(src_fd, offset, dst_fd):
+    """Copy src_fd from offset to its end into dst_fd in the kernel; returns the byte count"""
+    total = 0
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, offset + total, 64 * IO_BUFFER_SIZE)
+        if not sent:
+            return total
+        total += sent
+
+
+def save_stream(stream, path):
+    """Copy a readable stream to path in TEMP_DIR and return the byte count.
+
+    The name only appears once the copy is complete (unnamed inode linked in on
+    Linux); a failed copy leaves nothing behind.
+    """
+    fd = open_unnamed_temp(os.O_WRONLY)
+    unnamed = fd is not None
+    if not unnamed:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with open(fd, "wb", buffering=0) as dst:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            source = _stream_fd(stream) if hasattr(os, "sendfile") else None
+            if source is not None:
+                # upload spooled to a temp file: file-to-file sendfile, no userspace copy
+                size = _sendfile_all(*source, fd)
+            else:
+                # 1 MiB unbuffered writes instead of FileStorage.save()'s 16 KiB chunks
+                shutil.copyfileobj(stream, dst, length=IO_BUFFER_SIZE)
+                size = dst.tell()
+            if unnamed:
+                link_unnamed_temp(fd, path)
+    except Exception:
+        if not unnamed:
+            cleanup_temp_files(path)
+        raise
+    return size
+
+
+class OutputFile:
+    """ffmpeg output that only appears at its final path once complete.
+
+    On Linux ffmpeg writes an unnamed O_TMPFILE inode in TEMP_DIR that commit()
+    links into place; elsewhere it writes a partial_path sibling that is renamed.
+    path must be inside TEMP_DIR.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fd = None
+        muxer = _FFMPEG_MUXERS.get(fmt)
+        if muxer:
+            self.fd = open_unnamed_temp()
+        if self.fd is None:
+            self.partial = partial_path(path)
+            self.args = [self.partial]
+            self.run_kwargs = {}
+        else:
+            self.partial = None
+            self.args = ["-f", muxer, f"/dev/fd/{self.fd}"]
+            self.run_kwargs = {"pass_fds": (self.fd,)}
+
+    def commit(self):
+        """Make the finished output visible at self.path"""
+        if self.fd is None:
+            os.replace(self.partial, self.path)
+        else:
+            link_unnamed_temp(self.fd, self.path)
+
+    def close(self):
+        """Drop whatever was not committed"""
+        if self.fd is None:
+            cleanup_temp_files(self.partial)
+        else:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _pop_expired(now):
+    """Pop every scheduled path whose deadline has passed (caller holds the lock)"""
+    due = []
+    while _expiry_heap and _expiry_heap[0][0] <= now:
+        due.append(heapq.heappop(_expiry_heap)[1])
+    return due
+
+
+def enqueue_cleanup(*paths):
+    """Hand finished temp files to the cleanup worker so the unlinks happen off the
+    response path; removes them right away if this process has no worker running"""
+    paths = [p for p in paths if p]
+    if not paths:
+        return
+    if _cleanup_thread is None or not _cleanup_thread.is_alive():
+        # e.g. a worker forked after the thread was started (threads don't survive fork)
+        cleanup_temp_files(*paths)
+        return
+    with _expiry_cond:
+        for path in paths:
+            # a deadline of 0 is due immediately and sorts ahead of every real expiry
+            heapq.heappush(_expiry_heap, (0, path))
+        _expiry_cond.notify()
+
+
+def _unlink_all(paths):
+    """Unlink paths on the cleanup pool; yields (path, error), error None once removed"""
+    def unlink(path):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            return e
+    return zip(paths, _cleanup_executor.map(unlink, paths))
+
+
+def remove_expired_files(paths):
+    """Remove expired files, ignoring ones already cleaned up by their request"""
+    for path, error in _unlink_all(paths):
+        if error is None:
+            logger.info(f"Cleaned up expired file: {os.path.basename(path)}")
+        elif not isinstance(error, FileNotFoundError):
+            logger.error(f"Failed to clean up {path}: {error}")
+
+
+def cleanup_old_files():
+    """Clean up files older than FILE_RETENTION_HOURS
+
+    Returns the mtime of the oldest file left in place (None if there is none).
+    """
+    oldest = None
+    cleaned_count = 0
+    error_count = 0
+
+    def remove(expired):
+        nonlocal cleaned_count, error_count
+        ages = dict(expired)
+        for path, error in _unlink_all(list(ages)):
+            filename = os.path.basename(path)
+            if error is None:
+                cleaned_count += 1
+                logger.info(f"Cleaned up old file: {filename} (age: {ages[path]/3600:.1f}h)")
+            elif not isinstance(error, FileNotFoundError):
+                error_count += 1
+                logger.error(f"Failed to clean up {filename}: {error}")
+        expired.clear()
 
+    try:
         current_time = time.time()
         retention_seconds = FILE_RETENTION_HOURS * 3600
-        cleaned_count = 0
-        error_count = 0
+        expired = []
 
         logger.debug(f"Starting cleanup (retention: {FILE_RETENTION_HOURS} hours)")
 
-        for filename in os.listdir(TEMP_DIR):
-            file_path = os.path.join(TEMP_DIR, filename)
+        try:
+            entries = os.scandir(TEMP_DIR)
+        except FileNotFoundError:
+            logger.debug("Temp directory does not exist, skipping cleanup")
+            return None
 
-            # Skip input files (they should be cleaned immediately)
-            if filename.startswith("input_") or filename.startswith("upload_"):
-                continue
+        with entries:
+            for entry in entries:
+                filename = entry.name
 
-            if os.path.isfile(file_path):
-                file_age = current_time - os.path.getmtime(file_path)
-                if file_age > retention_seconds:
-                    try:
-                        os.remove(file_path)
-                        cleaned_count += 1
-                        logger.info(f"Cleaned up old file: {filename} (age: {file_age/3600:.1f}h)")
-                    except Exception as e:
-                        error_count += 1
-                        logger.error(f"Failed to clean up {filename}: {e}")
+                # Skip input files (they should be cleaned immediately)
+                if filename.startswith(("input_", "upload_")):
+                    continue
+
+                try:
+                    if not entry.is_file():
+                        continue
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                file_age = current_time - mtime
+                if file_age <= retention_seconds:
+                    oldest = mtime if oldest is None else min(oldest, mtime)
+                else:
+                    expired.append((entry.path, file_age))
+                    if len(expired) >= CLEANUP_BATCH:
+                        remove(expired)
+            remove(expired)
 
         if cleaned_count > 0 or error_count > 0:
             logger.info(f"Cleanup completed: {cleaned_count} files cleaned, {error_count} errors")
 
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
+    return oldest
+
+
+def _temp_dir_mtime():
+    """TEMP_DIR mtime in ns; changes whenever an entry is created, renamed or removed"""
+    try:
+        return os.stat(TEMP_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+
+_cleanup_thread = None
 
 
 def start_cleanup_thread():
     """Start background cleanup thread"""
+    global _cleanup_thread
     def cleanup_worker():
         logger.info("Cleanup worker thread started")
+        sweep_interval = CLEANUP_INTERVAL_MINUTES * 60
+        next_sweep = time.time() + sweep_interval
+        # state after the last sweep: TEMP_DIR mtime and when its oldest kept file expires
+        swept_mtime, kept_until = None, None
         while True:
-            time.sleep(CLEANUP_INTERVAL_MINUTES * 60)
-            cleanup_old_files()
-
-    cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
-    cleanup_thread.start()
+            with _expiry_cond:
+                now = time.time()
+                due = _pop_expired(now)
+                if not due and now < next_sweep:
+                    # sleep until the earliest scheduled expiry or the next full sweep
+                    wake_at = min(_expiry_heap[0][0], next_sweep) if _expiry_heap else next_sweep
+                    _expiry_cond.wait(timeout=wake_at - now)
+                    continue
+            remove_expired_files(due)
+            now = time.time()
+            if now >= next_sweep:
+                next_sweep = now + sweep_interval
+                # nothing added or removed since the last sweep and nothing aged out: skip the scan
+                if swept_mtime is not None and swept_mtime == _temp_dir_mtime() and (kept_until is None or kept_until > now):
+                    continue
+                # full directory sweep catches files from other workers or previous runs
+                oldest = cleanup_old_files()
+                kept_until = None if oldest is None else oldest + FILE_RETENTION_HOURS * 3600
+                swept_mtime = _temp_dir_mtime()
+
+    _cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
+    _cleanup_thread.start()
     logger.info(
         f"Started cleanup thread (interval: {CLEANUP_INTERVAL_MINUTES} minutes, retention: {FILE_RETENTION_HOURS} hours)"
     )
 
 # ---------- NEW HELPERS: subtitle & bgm ----------
+_URL_RE = re.compile(r"^https?://", re.IGNORECASE)
+
 def _ensure_local_path(maybe_url_or_path, kind="generic"):
     if not maybe_url_or_path:
         raise ValueError(f"{kind} is required")
-    if isinstance(maybe_url_or_path, str) and re.match(r"^https?://", maybe_url_or_path):
+    if isinstance(maybe_url_or_path, str) and _URL_RE.match(maybe_url_or_path):
         return download_media_from_url(maybe_url_or_path)
     return maybe_url_or_path
 
-def _apply_hard_subtitle(video_path, sub_path, fonts_dir=None, crf="23", preset="veryfast"):
-    out_name = f"sub_hard_{uuid.uuid4().hex}.mp4"
-    out_path = os.path.join(TEMP_DIR, out_name)
+def _is_ffmpeg_fetchable(url):
+    """True when ffmpeg can read url itself: it has to seek (e.g. to an mp4's trailing
+    moov), so the server must serve byte ranges"""
+    # a server's range support doesn't change between requests: HEAD each URL once per window
+    return _head_accepts_ranges(url, int(time.monotonic() // 600))
+
+@lru_cache(maxsize=256)
+def _head_accepts_ranges(url, _window):
+    try:
+        with _http.head(url, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True) as response:
+            return response.ok and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except requests.exceptions.RequestException:
+        return False
+
+def _ensure_ffmpeg_input(maybe_url_or_path, kind="generic"):
+    """Like _ensure_local_path, for an input that one ffmpeg run reads once: with
+    STREAM_URL_INPUTS a URL ffmpeg can fetch is handed to it as is"""
+    if (
+        STREAM_URL_INPUTS and isinstance(maybe_url_or_path, str)
+        and _URL_RE.match(maybe_url_or_path) and _is_ffmpeg_fetchable(maybe_url_or_path)
+    ):
+        return maybe_url_or_path
+    return _ensure_local_path(maybe_url_or_path, kind)
+
+def url_input_options(src):
+    """Demuxer options for an input ffmpeg fetches itself: plain HTTP(S) only (no
+    playlist redirecting it to local files) and give up on a stalled server"""
+    if not _URL_RE.match(str(src)):
+        return {}
+    return {"protocol_whitelist": "http,https,tcp,tls", "rw_timeout": str(DOWNLOAD_TIMEOUT[1] * 1000000)}
+
+def url_input_args(src):
+    """url_input_options as ffmpeg arguments; goes right before that input's -i"""
+    return [arg for key, value in url_input_options(src).items() for arg in (f"-{key}", value)]
+
+def _subtitles_filter(sub_path, fonts_dir=None):
     vf = f"subtitles={sub_path}"
     if fonts_dir:
         vf += f":fontsdir={fonts_dir}"
-    cmd = [
-        "ffmpeg", "-y", "-i", video_path, "-vf", vf,
-        "-c:v", "libx264", "-crf", str(crf), "-preset", str(preset),
-        "-c:a", "copy", out_path
+    return vf
+
+def _hard_subtitle_cmd(video_path, sub_path, fonts_dir, crf, preset, output, encoder="libx264"):
+    vf = _subtitles_filter(sub_path, fonts_dir)
+    return [
+        "ffmpeg", "-y", *h264_input_args(encoder), *h264_decode_args(encoder), *ffmpeg_threads(),
+        *url_input_args(video_path), "-i", video_path, "-vf", ",".join(h264_filters(encoder, [vf])),
+        "-c:v", encoder, *h264_quality_args(encoder, crf, str(preset)),
+        "-c:a", "copy", "-threads", str(FFMPEG_THREADS), *output
     ]
-    r = run_cmd(cmd, capture_output=True, text=True)
+
+def _apply_hard_subtitle(video_path, sub_path, fonts_dir=None, crf="23", preset="veryfast"):
+    out_name = f"sub_hard_{token_hex(16)}.mp4"
+    out_path = new_temp_path(out_name)
+    r = run_h264_ffmpeg(lambda encoder: _hard_subtitle_cmd(video_path, sub_path, fonts_dir, crf, preset, [out_path], encoder))
     if r.returncode != 0:
         raise Exception(f"Hard-sub failed: {r.stderr}")
     return out_path
 
 def _apply_soft_subtitle(video_path, sub_path):
-    out_name = f"sub_soft_{uuid.uuid4().hex}.mp4"
-    out_path = os.path.join(TEMP_DIR, out_name)
+    out_name = f"sub_soft_{token_hex(16)}.mp4"
+    out_path = new_temp_path(out_name)
+    if _PYAV_SUBTITLE_MUX:
+        # mux beside the final name so a failed attempt never shows up at out_path
+        partial = partial_path(out_path)
+        try:
+            _mux_soft_subtitle_pyav(video_path, sub_path, partial)
+            os.replace(partial, out_path)
+            return out_path
+        except Exception as e:
+            cleanup_temp_files(partial)
+            logger.debug(f"In-process subtitle mux unavailable, using ffmpeg: {e}")
     cmd = [
-        "ffmpeg", "-y", "-i", video_path, "-i", sub_path,
+        "ffmpeg", "-y", *ffmpeg_threads(), *url_input_args(video_path), "-i", video_path, "-i", sub_path,
         "-c:v", "copy", "-c:a", "copy",
         "-c:s", "mov_text", "-metadata:s:s:0", "language=th",
         out_path
     ]
-    r = run_cmd(cmd, capture_output=True, text=True)
+    r = run_ffmpeg(cmd)
     if r.returncode != 0:
         raise Exception(f"Soft-sub failed: {r.stderr}")
     return out_path
 
-def _mix_bgm(video_path, bgm_path, mode="mix", bgm_gain=0.25):
-    out_name = f"bgm_{uuid.uuid4().hex}.mp4"
-    out_path = os.path.join(TEMP_DIR, out_name)
+def _mux_soft_subtitle_pyav(video_path, sub_path, out_path):
+    """Same mux as the ffmpeg soft-sub command, done in-process with PyAV: copy the
+    first video/audio streams and add the subtitles as a mov_text track"""
+    with _ffmpeg_sem, av.open(video_path, options=url_input_options(video_path)) as src, av.open(sub_path) as subs, av.open(out_path, "w", format="mp4") as out:
+        copied = {}
+        for streams in (src.streams.video, src.streams.audio):
+            if streams:
+                copied[streams[0].index] = out.add_stream_from_template(streams[0])
+        sub_in = subs.streams.subtitles[0]
+        decoded = []
+        for packet in subs.demux(sub_in):
+            if packet.pts is None:
+                continue
+            subtitle = sub_in.codec_context.decode2(packet)
+            if subtitle is not None:
+                decoded.append((packet, subtitle))
+        sub_out = out.add_stream("mov_text")
+        sub_out.metadata["language"] = "th"
+        sub_out.time_base = sub_in.time_base
+        # the ASS header is only known once the decoder has run
+        sub_out.codec_context.subtitle_header = sub_in.codec_context.subtitle_header
+        sub_out.codec_context.time_base = sub_in.time_base
+        pending = []
+        for packet, subtitle in decoded:
+            encoded = sub_out.codec_context.encode_subtitle(subtitle)
+            encoded.pts = encoded.dts = packet.pts
+            encoded.duration = packet.duration
+            encoded.time_base = sub_in.time_base
+            encoded.stream = sub_out
+            pending.append(encoded)
+        pending.sort(key=lambda pkt: pkt.pts, reverse=True)
+
+        for packet in src.demux(*[src.streams[idx] for idx in copied]):
+            if packet.dts is None:
+                continue
+            # keep the (few) subtitle packets interleaved with the copied streams
+            now = packet.dts * packet.time_base
+            while pending and pending[-1].pts * pending[-1].time_base <= now:
+                out.mux(pending.pop())
+            packet.stream = copied[packet.stream.index]
+            out.mux(packet)
+        while pending:
+            out.mux(pending.pop())
+
+def _bgm_filter(main, bgm, mode, bgm_gain, out, tag=""):
+    """Graph mixing the bgm audio pad under main into out; tag keeps the inner labels unique"""
     if mode == "ducking":
-        filter_complex = f"[1:a]volume={bgm_gain}[b];[0:a][b]sidechaincompress=threshold=0.03:ratio=8:attack=5:release=200[outa]"
-    else:
-        filter_complex = f"[0:a]volume=1.0[a0];[1:a]volume={bgm_gain}[a1];[a0][a1]amix=inputs=2:dropout_transition=2:normalize=1[outa]"
-    cmd = [
-        "ffmpeg", "-y", "-i", video_path, "-i", bgm_path,
+        return f"{bgm}volume={bgm_gain}[b{tag}];{main}[b{tag}]sidechaincompress=threshold=0.03:ratio=8:attack=5:release=200{out}"
+    return f"{main}volume=1.0[a0{tag}];{bgm}volume={bgm_gain}[a1{tag}];[a0{tag}][a1{tag}]amix=inputs=2:dropout_transition=2:normalize=1{out}"
+
+def _mix_bgm_cmd(video_path, bgm_path, mode, bgm_gain, output):
+    filter_complex = _bgm_filter("[0:a]", "[1:a]", mode, bgm_gain, "[outa]")
+    return [
+        "ffmpeg", "-y", *ffmpeg_threads(),
+        *url_input_args(video_path), "-i", video_path, *url_input_args(bgm_path), "-i", bgm_path,
         "-filter_complex", filter_complex, "-map", "0:v", "-map", "[outa]",
-        "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", out_path
+        "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", "-threads", str(FFMPEG_THREADS), *output
     ]
-    r = run_cmd(cmd, capture_output=True, text=True)
+
+def _mix_bgm(video_path, bgm_path, mode="mix", bgm_gain=0.25):
+    out_name = f"bgm_{token_hex(16)}.mp4"
+    out_path = new_temp_path(out_name)
+    cmd = _mix_bgm_cmd(video_path, bgm_path, mode, bgm_gain, [out_path])
+    r = run_ffmpeg(cmd)
     if r.returncode != 0:
         raise Exception(f"BGM mix failed: {r.stderr}")
     return out_path
 
+class PipelineBuilder:
+    """Collects /edit steps into a single ffmpeg filter graph.
+
+    Concat, hard subtitles, BGM mixing and soft subtitle tracks only add inputs,
+    filter chains and mappings, so a run of them costs one decode and at most one
+    encode; run() executes the graph once a step needs the result as a file.
+    """
+
+    def __init__(self, source=None):
+        self.inputs = []  # (path, is_video_source)
+        self.chains = []
+        self.video = self.audio = None  # current pads; "[0:v:0]"-style until filtered
+        self.filtered_audio = False
+        self.subtitles = []  # input indexes muxed as soft subtitle tracks
+        self.shots = []  # screenshot outputs split off the final video
+        self.steps = []
+        self.encode = False
+        self.crf, self.preset = "23", "veryfast"
+        self.name = None
+        if source:
+            i = self._input(source, video=True)
+            self.video, self.audio = f"[{i}:v:0]", f"[{i}:a:0]"
+
+    def _input(self, path, video=False):
+        self.inputs.append((path, video))
+        return len(self.inputs) - 1
+
+    def _step(self, label, name, crf=None, preset=None):
+        self.steps.append(label)
+        self.name = name
+        if crf is not None:
+            self.encode = True
+            self.crf, self.preset = str(crf), preset or "veryfast"
+
+    def concat(self, paths, vf, crf, preset, audio=True):
+        """Replace the graph's source with paths, each run through vf, joined end to end"""
+        pads = []
+        for path in paths:
+            i = self._input(path, video=True)
+            video = f"[{i}:v:0]"
+            if vf:
+                self.chains.append(f"{video}{','.join(vf)}[v{i}]")
+                video = f"[v{i}]"
+            pads.append(f"{video}[{i}:a:0]" if audio else video)
+        outputs = "[cv][ca]" if audio else "[cv]"
+        self.chains.append(f"{''.join(pads)}concat=n={len(paths)}:v=1:a={int(audio)}{outputs}")
+        self.video, self.audio, self.filtered_audio = "[cv]", ("[ca]" if audio else None), audio
+        self._step("concat", "concat", crf, preset)
+
+    def hard_subtitle(self, sub_path, fonts_dir, crf, preset):
+        out = f"[hs{len(self.steps)}]"
+        self.chains.append(f"{self.video}{_subtitles_filter(sub_path, fonts_dir)}{out}")
+        self.video = out
+        self._step("hard-sub", "sub_hard", crf, preset)
+
+    def bgm(self, bgm_path, mode="mix", bgm_gain=0.25):
+        tag = len(self.steps)
+        i = self._input(bgm_path)
+        out = f"[bgm{tag}]"
+        self.chains.append(_bgm_filter(self.audio, f"[{i}:a]", mode, bgm_gain, out, tag))
+        self.audio, self.filtered_audio = out, True
+        self._step("BGM mix", "bgm")
+
+    def soft_subtitle(self, sub_path):
+        self.subtitles.append(self._input(sub_path))
+        self._step("soft-sub", "sub_soft")
+
+    def duration(self):
+        """Length of the graph's video: its source, or the concatenated inputs"""
+        return sum(float(probe_media(path).get("format", {}).get("duration", 0))
+                   for path, video in self.inputs if video)
+
+    def screenshots(self, timestamps=None, count=None):
+        """Grab frames of the final video from the same decode (split filter) instead of
+        decoding the written result again; only for a graph that re-encodes the video.
+
+        Returns False, adding nothing, when a timestamp is near or past the end: an
+        output that never gets a frame fails the whole ffmpeg run.
+        """
+        duration = self.duration()
+        capture_at = screenshot_times(duration, timestamps, count)
+        if not capture_at or max(capture_at) > duration - 1:
+            return False
+        for timestamp in capture_at:
+            filename = f"screenshot_{token_hex(16)}_{int(timestamp)}.jpg"
+            self.shots.append({"timestamp": timestamp, "filename": filename, "file_path": new_temp_path(filename)})
+        return True
+
+    def cmd(self, encoder, out_path):
+        cmd = ["ffmpeg", "-y", *(h264_input_args(encoder) if self.encode else [])]
+        for path, video in self.inputs:
+            if video and self.encode:
+                cmd.extend(h264_decode_args(encoder))
+            # -threads is per input: every decoder gets the cap, not just the first
+            cmd.extend([*ffmpeg_threads(), *url_input_args(path), "-i", path])
+        chains, video = list(self.chains), self.video
+        if self.shots:
+            pads = [f"[shot{n}]" for n in range(len(self.shots))]
+            chains.append(f"{video}split={len(self.shots) + 1}[vmain]{''.join(pads)}")
+            # trim runs on the frames' output timestamps, the same ones -ss seeks on the file
+            chains.extend(f"{pad}trim=start={shot['timestamp']}[shot{n}out]"
+                          for n, (pad, shot) in enumerate(zip(pads, self.shots)))
+            video = "[vmain]"
+        upload = h264_filters(encoder, []) if self.encode else []
+        if upload:
+            chains.append(f"{video}{','.join(upload)}[vhw]")
+            video = "[vhw]"
+        if chains:
+            cmd.extend(["-filter_complex", ";".join(chains)])
+        # an untouched stream is mapped by its spec, a filter output by its pad
+        cmd.extend(["-map", video.strip("[]") if ":" in video else video])
+        if self.audio is None:
+            cmd.append("-an")
+        elif self.filtered_audio:
+            cmd.extend(["-map", self.audio, "-c:a", "aac"])
+            if "BGM mix" in self.steps:
+                cmd.extend(["-b:a", "192k"])
+        else:
+            cmd.extend(["-map", f"{self.audio.strip('[]')}?", "-c:a", "copy"])
+        for n, i in enumerate(self.subtitles):
+            cmd.extend(["-map", f"{i}:s:0", f"-metadata:s:s:{n}", "language=th"])
+        if self.subtitles:
+            cmd.extend(["-c:s", "mov_text"])
+        if self.encode:
+            cmd.extend(["-c:v", encoder, *h264_quality_args(encoder, self.crf, self.preset)])
+        else:
+            cmd.extend(["-c:v", "copy"])
+        cmd.extend(["-movflags", "+faststart", "-threads", str(FFMPEG_THREADS), out_path])
+        for n, shot in enumerate(self.shots):
+            cmd.extend(["-map", f"[shot{n}out]", "-frames:v", "1", "-q:v", "2", shot["file_path"]])
+        return cmd
+
+    def run(self):
+        """Execute the collected steps into a new TEMP_DIR file and return its path"""
+        out_path = new_temp_path(f"{self.name}_{token_hex(16)}.mp4")
+        label = " + ".join(self.steps)
+
+        def build(encoder):
+            cmd = self.cmd(encoder, out_path)
+            log_cmd(f"[edit {label}]", cmd)
+            return cmd
+        r = run_h264_ffmpeg(build) if self.encode else run_ffmpeg(build("copy"))
+        if r.returncode != 0:
+            cleanup_temp_files(out_path, *[s["file_path"] for s in self.shots])
+            raise Exception(f"{label[0].upper()}{label[1:]} failed: {r.stderr}")
+        for shot in self.shots:
+            shot["file_size"] = os.path.getsize(shot["file_path"])
+            shot["url"] = create_download_url(shot["filename"])
+        return out_path
+
+
+def _concat_cmd(inputs, vf, crf, preset, out_path, encoder="libx264", audio=True):
+    """One ffmpeg run that applies the vf chain to each input and concatenates them"""
+    graph = PipelineBuilder()
+    graph.concat(inputs, vf, crf, preset, audio=audio)
+    return graph.cmd(encoder, out_path)
+
+
+def _display_rotation(path, video):
+    """Rotation of a video stream's display matrix: ffprobe reports it as side data,
+    PyAV only on decoded frames"""
+    for side_data in video.get("side_data_list") or []:
+        if "rotation" in side_data:
+            return int(side_data["rotation"])
+    if not _PYAV_FRAME_ROTATION:
+        # PyAV too old to report it (or absent): ask ffprobe for the side data
+        streams = _parse_ffprobe(_run_ffprobe(path)).get("streams", [])
+        for stream in streams:
+            if stream.get("index") == video.get("index"):
+                for side_data in stream.get("side_data_list") or []:
+                    if "rotation" in side_data:
+                        return int(side_data["rotation"])
+        return 0
+    with av.open(path) as container:
+        frame = next(container.decode(video=0), None)
+    return (frame.rotation or 0) if frame else 0
+
+
+def _concat_stream_params(path, audio=True):
+    """The stream parameters that must match for inputs to be joined by stream copy"""
+    streams = probe_media(path).get("streams", [])
+    video = [s for s in streams if s.get("codec_type") == "video"]
+    audio = [s for s in streams if s.get("codec_type") == "audio"] if audio else []
+    if len(video) != 1 or len(audio) > 1:
+        return None
+    v, a = video[0], (audio[0] if audio else {})
+    return (
+        v.get("codec_name"), v.get("profile"), v.get("width"), v.get("height"),
+        v.get("pix_fmt"), v.get("r_frame_rate"), _display_rotation(path, v),
+        a.get("codec_name"), a.get("sample_rate"), a.get("channels"),
+    )
+
+
+def _can_concat_copy(inputs, audio=True):
+    """True when all inputs carry identical H.264 (+ mp4-compatible audio) streams"""
+    try:
+        params = {_concat_stream_params(p, audio) for p in inputs}
+    except Exception as e:
+        logger.debug(f"Probe failed, not stream-copying concat: {e}")
+        return False
+    if len(params) != 1:
+        return False
+    (p,) = params
+    if p is None or p[0] != "h264":
+        return False
+    return p[7] is None or p[7] in REMUX_AUDIO_CODECS["mp4"]
+
+
+def _concat_copy(inputs, out_path, audio=True):
+    """Join inputs with the concat demuxer and -c copy: no decode, no encode"""
+    list_path = new_temp_path(f"concat_list_{local_temp_id()}.txt")
+    try:
+        with open(list_path, "w", encoding="utf-8") as f:
+            for p in inputs:
+                escaped = os.path.abspath(p).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        cmd = [
+            "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path,
+            "-map", "0:v:0", *(["-map", "0:a:0?"] if audio else ["-an"]),
+            "-c", "copy", "-movflags", "+faststart", out_path,
+        ]
+        log_cmd("[concat-copy]", cmd)
+        return run_ffmpeg(cmd)
+    finally:
+        cleanup_temp_files(list_path)
+
+def _process_media_job(processor, result, shot_args, convert_args, input_files=None):
+    """Run the screenshot/conversion part of /process and add their results to result"""
+    # screenshots and conversion are independent ffmpeg runs, so run them side by side
+    jobs = {}
+    if shot_args:
+        timestamps, count = shot_args
+        jobs["screenshots"] = _executor.submit(processor.take_screenshots, timestamps=timestamps, count=count)
+    if isinstance(convert_args, list):
+        jobs["conversions"] = _executor.submit(processor.convert_formats, convert_args)
+    elif convert_args:
+        jobs["conversion"] = _executor.submit(processor.convert_format, *convert_args)
+
+    # wait for all jobs so a failing one never leaves the other's outputs behind
+    wait(jobs.values())
+    output_files = []
+    job_error = None
+    for key, job in jobs.items():
+        if job.exception() is not None:
+            job_error = job_error or job.exception()
+            continue
+        result[key] = job.result()
+        if key in ("screenshots", "conversions"):
+            output_files.extend([s["file_path"] for s in result[key]])
+        else:
+            output_files.append(result[key]["file_path"])
+    if job_error:
+        cleanup_temp_files(*output_files)
+        raise job_error
+    if input_files:
+        cleanup_temp_files(*input_files)
+    return result
+
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{16}$")
+
+def _job_status_path(job_id):
+    return os.path.join(TEMP_DIR, f"job_{job_id}.json")
+
+def create_job_url(job_id):
+    """Status URL for a background job, absolute when BASE_URL is set"""
+    return f"{BASE_URL}/jobs/{job_id}" if BASE_URL else f"/jobs/{job_id}"
+
+def _write_job_status(job_id, **state):
+    # status lives on disk so any gunicorn worker can answer /jobs/<id>
+    state["job_id"] = job_id
+    state["updated_at"] = datetime.now().isoformat()
+    path = _job_status_path(job_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_job_status(job_id):
+    """Return a job's status dict, or None for an unknown id.
+
+    Jobs run on threads of the worker that queued them, so a recycled or killed
+    worker takes its jobs with it; a queued/running job whose worker is gone, or
+    that has run past JOB_STALE_SECONDS, is reported as failed.
+    """
+    if not _JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with open(_job_status_path(job_id)) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if state.get("status") in ("queued", "running"):
+        pid = state.get("pid")
+        started = state.get("started_at")
+        if pid and not _pid_alive(pid):
+            state.update(status="failed", error="Worker exited before the job finished")
+        elif started and time.time() - started > JOB_STALE_SECONDS:
+            state.update(status="failed", error="Job did not finish in time")
+    return state
+
+def submit_job(fn, *args, inputs=()):
+    """Queue fn(*args) as a background job; returns its id, or None when the queue is full.
+
+    inputs are removed if the job fails; on success fn cleans them up itself.
+    """
+    if not _job_slots.acquire(blocking=False):
+        return None
+    job_id = token_hex(8)
+    try:
+        new_temp_path(f"job_{job_id}.json")  # expire the status file with the outputs
+        _write_job_status(job_id, status="queued", pid=os.getpid())
+    except Exception:
+        _job_slots.release()
+        raise
+
+    def run():
+        try:
+            _write_job_status(job_id, status="running", pid=os.getpid(), started_at=time.time())
+            result = fn(*args)
+            _write_job_status(job_id, status="completed", result=result)
+            logger.info(f"Job {job_id} completed")
+        except Exception as e:
+            cleanup_temp_files(*inputs)
+            _write_job_status(job_id, status="failed", error=_short_err(e))
+            logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+        finally:
+            _job_slots.release()
+
+    _job_executor.submit(run)
+    logger.info(f"Job {job_id} queued")
+    return job_id
+
 
 # API Routes
-@app.route("/", methods=["GET"])
-def homepage():
-    """Homepage with project information"""
-    html_content = """
+_HOMEPAGE_BYTES = """\
 <!DOCTYPE html>
 <html lang="zh-CN">
 <head>
@@ -989,8 +2565,17 @@ def homepage():
     </div>
 </body>
 </html>
-    """
-    return html_content
+""".encode("utf-8")
+
+
+@app.route("/", methods=["GET"])
+def homepage():
+    """Homepage with project information"""
+    return app.response_class(
+        _HOMEPAGE_BYTES,
+        content_type="text/html; charset=utf-8",
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
 
 
 @app.route("/health", methods=["GET"])
@@ -1006,7 +2591,6 @@ def process_media():
     request_id = log_request_info()
     
     input_files = []   # will be removed
-    output_files = []  # keep for download
 
     try:
         logger.info(f"Processing request {request_id}: media processing started")
@@ -1019,6 +2603,7 @@ def process_media():
         convert_format = data.get("convert_format")
         convert_quality = data.get("convert_quality", "medium")
         convert_resolution = data.get("convert_resolution")
+        run_async = _parse_bool(data.get("async", False))
 
         # media
         media_path = None
@@ -1040,43 +2625,58 @@ def process_media():
             else:
                 result["info"] = processor.get_audio_info()
 
-        if take_screenshots and media_type == "video":
-            shots = processor.take_screenshots(
-                timestamps=screenshot_timestamps, count=screenshot_count
-            )
-            result["screenshots"] = shots
-            output_files.extend([s["file_path"] for s in shots])
-        elif take_screenshots and media_type == "audio":
-            result["warning"] = "Screenshots not supported for audio files"
-
+        convert_args = None
         if convert_format:
             if media_type == "video" and convert_format in SUPPORTED_VIDEO_OUTPUT_FORMATS:
-                conv = processor.convert_format(convert_format, convert_quality, convert_resolution)
+                resolutions = _split_list(convert_resolution) if isinstance(convert_resolution, str) else convert_resolution
+                if isinstance(resolutions, list) and len(resolutions) > 1:
+                    # several renditions: encoded side by side from a single decode
+                    convert_args = [(convert_format, convert_quality, res) for res in resolutions]
+                else:
+                    if isinstance(resolutions, list):
+                        resolutions = resolutions[0] if resolutions else None
+                    convert_args = (convert_format, convert_quality, resolutions)
             elif media_type == "audio" and convert_format in SUPPORTED_AUDIO_OUTPUT_FORMATS:
-                conv = processor.convert_format(convert_format, convert_quality)
+                convert_args = (convert_format, convert_quality)
             else:
                 supported_formats = SUPPORTED_VIDEO_OUTPUT_FORMATS if media_type == "video" else SUPPORTED_AUDIO_OUTPUT_FORMATS
-                raise ValueError(f"Unsupported format '{convert_format}' for {media_type}. Supported formats: {supported_formats}")
-            result["conversion"] = conv
-            output_files.append(conv["file_path"])
+                raise ValueError(f"Unsupported format '{convert_format}' for {media_type}. Supported formats: {', '.join(sorted(supported_formats))}")
 
-        cleanup_temp_files(*input_files)
+        if take_screenshots and media_type == "audio":
+            result["warning"] = "Screenshots not supported for audio files"
+        shot_args = (screenshot_timestamps, screenshot_count) if take_screenshots and media_type == "video" else None
+
+        if run_async:
+            job_id = submit_job(
+                _process_media_job, processor, result, shot_args, convert_args, input_files, inputs=input_files
+            )
+            if job_id is None:
+                cleanup_temp_files(*input_files)
+                log_response_info(request_id, 503, (time.time() - start_time) * 1000)
+                return create_response(code=503, msg="Job queue is full, retry later"), 503
+            data = {"job_id": job_id, "status": "queued", "status_url": create_job_url(job_id)}
+            log_response_info(request_id, 202, (time.time() - start_time) * 1000, data)
+            return create_response(msg="Job queued", data=data), 202
+
+        result = _process_media_job(processor, result, shot_args, convert_args)
+
+        enqueue_cleanup(*input_files)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 200, elapsed, result)
         return create_response(msg="Media processing completed successfully", data=result)
 
     except ValueError as e:
-        cleanup_temp_files(*(input_files + output_files))
+        cleanup_temp_files(*input_files)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 400, elapsed)
         log_error(request_id, e, {"endpoint": "/process"})
         return create_response(code=400, msg=str(e)), 400
     except Exception as e:
-        cleanup_temp_files(*(input_files + output_files))
+        cleanup_temp_files(*input_files)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 500, elapsed)
         log_error(request_id, e, {"endpoint": "/process"})
-        return create_response(code=500, msg=f"Processing failed: {str(e)}"), 500
+        return create_response(code=500, msg=f"Processing failed: {_short_err(e)}"), 500
 
 
 @app.route("/bgm", methods=["POST"])
@@ -1094,7 +2694,9 @@ def add_bgm():
 
         # video
         if "media_url" in (data or {}) and data.get("media_url"):
-            video_path = download_media_from_url(data.get("media_url")); temp_inputs.append(video_path)
+            video_path = _ensure_ffmpeg_input(data.get("media_url"), "media_url")
+            if not _URL_RE.match(video_path):
+                temp_inputs.append(video_path)
         elif "file" in request.files:
             video_path = save_uploaded_file(request.files["file"]); temp_inputs.append(video_path)
         else:
@@ -1102,21 +2704,23 @@ def add_bgm():
 
         # bgm
         if "bgm_url" in (data or {}) and data.get("bgm_url"):
-            bgm_path = download_media_from_url(data.get("bgm_url")); temp_inputs.append(bgm_path)
+            bgm_path = _ensure_ffmpeg_input(data.get("bgm_url"), "bgm_url")
+            if not _URL_RE.match(bgm_path):
+                temp_inputs.append(bgm_path)
         elif "bgm" in request.files:
             f = request.files["bgm"]
-            bgm_name = f"bgm_{uuid.uuid4().hex}{os.path.splitext(f.filename or '')[1]}"
-            bgm_path = os.path.join(TEMP_DIR, bgm_name); f.save(bgm_path); temp_inputs.append(bgm_path)
+            bgm_name = f"bgm_{token_hex(16)}{os.path.splitext(f.filename or '')[1]}"
+            bgm_path = new_temp_path(bgm_name); save_stream(f.stream, bgm_path); temp_inputs.append(bgm_path)
         else:
             return create_response(code=400, msg="Need bgm_url or bgm file"), 400
 
         output_file = _mix_bgm(video_path, bgm_path, mode=mode, bgm_gain=bgm_gain)
         result = {
-            "output": {"filename": os.path.basename(output_file), "url": create_download_url(os.path.basename(output_file))},
+            "output": output_entry(output_file),
             "mode": mode, "bgm_gain": bgm_gain
         }
 
-        cleanup_temp_files(*temp_inputs)
+        enqueue_cleanup(*temp_inputs)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 200, elapsed, result)
         return create_response(msg="BGM mixed", data=result)
@@ -1124,7 +2728,7 @@ def add_bgm():
     except Exception as e:
         cleanup_temp_files(*(temp_inputs + ([output_file] if output_file else [])))
         log_error(request_id, e, {"endpoint": "/bgm"})
-        return create_response(code=500, msg=f"BGM mix failed: {str(e)}"), 500
+        return create_response(code=500, msg=f"BGM mix failed: {_short_err(e)}"), 500
 
 
 @app.route("/edit", methods=["POST"])
@@ -1155,19 +2759,24 @@ def edit_pipeline():
         ops = payload.get("operations") or []
 
         # inputs
-        local_inputs = []
-        for it in inputs:
-            url = it.get("url")
-            if url:
-                p = download_media_from_url(url)
-                temp_inputs.append(p)
-                local_inputs.append(p)
+        local_inputs = download_media_from_urls([it["url"] for it in inputs if it.get("url")])
+        temp_inputs.extend(local_inputs)
 
         current = local_inputs[0] if len(local_inputs) == 1 else None
-
+        # concat/subtitle/bgm steps only extend this graph; it is executed once a later
+        # step (or the response) needs the result as a file
+        graph = PipelineBuilder(current)
         screenshots = []
         info = None
 
+        def flush(graph):
+            nonlocal current
+            if graph.steps:
+                current = graph.run()
+                temp_inter.append(current)
+                screenshots.extend(graph.shots)
+            return PipelineBuilder(current)
+
         for op in ops:
             t = (op.get("type") or "").lower()
 
@@ -1179,46 +2788,24 @@ def edit_pipeline():
                 if len(local_inputs) < 2:
                     return create_response(code=400, msg="concat requires inputs >= 2"), 400
 
-                # normalize
-                norm_paths = []
-                for idx, src in enumerate(local_inputs, 1):
-                    norm_name = f"norm_{uuid.uuid4().hex}_{idx}.mp4"
-                    norm_path = os.path.join(TEMP_DIR, norm_name)
-                    cmd = ["ffmpeg", "-y", "-i", src, "-c:v", "libx264", "-preset", preset, "-crf", crf]
-                    # audio
-                    cmd += ["-c:a", "aac"]
-                    vf = []
-                    if res:
-                        try:
-                            r = VideoProcessor(src)._parse_resolution(res)
-                            if r: vf.append(f"scale={r}")
-                        except Exception:
-                            pass
-                    if fps and fps > 0:
-                        vf.append(f"fps={fps}")
-                    if vf:
-                        cmd.extend(["-vf", ",".join(vf)])
-                    cmd.append(norm_path)
-                    r = run_cmd(cmd, capture_output=True, text=True)
-                    if r.returncode != 0:
-                        raise Exception(f"Normalization failed: {r.stderr}")
-                    norm_paths.append(norm_path); temp_inter.append(norm_path)
-
-                # concat
-                cmd = ["ffmpeg", "-y"]
-                for p in norm_paths: cmd.extend(["-i", p])
-                n = len(norm_paths)
-                filter_inputs = "".join([f"[{i}:v:0][{i}:a:0]" for i in range(n)])
-                filter_graph = f"{filter_inputs}concat=n={n}:v=1:a=1[outv][outa]"
-                out_name = f"concat_{uuid.uuid4().hex}.mp4"
-                current = os.path.join(TEMP_DIR, out_name)
-                cmd.extend(["-filter_complex", filter_graph, "-map", "[outv]", "-map", "[outa]", "-movflags", "+faststart", current])
-                r = run_cmd(cmd, capture_output=True, text=True)
-                if r.returncode != 0:
-                    raise Exception(f"Concat failed: {r.stderr}")
+                # per-input scale/fps chains feed the concat filter directly, so nothing
+                # is encoded twice or staged on disk
+                vf = []
+                if res:
+                    try:
+                        r = VideoProcessor._parse_resolution(res)
+                        if r: vf.append(f"scale={r}")
+                    except Exception:
+                        pass
+                if fps and fps > 0:
+                    vf.append(f"fps={fps}")
+
+                # concat replaces the source, so steps queued so far would be thrown away
+                graph = PipelineBuilder()
+                graph.concat(local_inputs, vf, crf, preset)
 
             elif t == "subtitle":
-                if not current:
+                if graph.video is None:
                     return create_response(code=400, msg="subtitle requires a video (concat or single input first)"), 400
                 mode = (op.get("mode") or "hard").lower()
                 sub_url = op.get("subtitle_url") or op.get("url")
@@ -1230,23 +2817,31 @@ def edit_pipeline():
 
                 sub_path = _ensure_local_path(sub_url, "subtitle")
                 temp_inputs.append(sub_path)
-                current = _apply_soft_subtitle(current, sub_path) if mode == "soft" else _apply_hard_subtitle(current, sub_path, fonts_dir, crf, preset)
-                temp_inter.append(current)
+                if mode == "soft" and not graph.steps:
+                    # nothing to fuse with: the in-process mux beats spawning ffmpeg
+                    current = _apply_soft_subtitle(current, sub_path)
+                    temp_inter.append(current)
+                    graph = PipelineBuilder(current)
+                elif mode == "soft":
+                    graph.soft_subtitle(sub_path)
+                else:
+                    graph.hard_subtitle(sub_path, fonts_dir, crf, preset)
 
             elif t in ("bgm", "bgm_mix"):
-                if not current:
+                if graph.video is None:
                     return create_response(code=400, msg="bgm requires a video (concat or single input first)"), 400
                 bgm_url = op.get("bgm_url") or op.get("url")
                 mode = (op.get("mode") or "mix").lower()
                 bgm_gain = float(op.get("bgm_gain") or 0.25)
                 if not bgm_url:
                     return create_response(code=400, msg="bgm_url is required"), 400
-                bgm_path = _ensure_local_path(bgm_url, "bgm")
-                temp_inputs.append(bgm_path)
-                current = _mix_bgm(current, bgm_path, mode=mode, bgm_gain=bgm_gain)
-                temp_inter.append(current)
+                bgm_path = _ensure_ffmpeg_input(bgm_url, "bgm")
+                if not _URL_RE.match(bgm_path):
+                    temp_inputs.append(bgm_path)
+                graph.bgm(bgm_path, mode=mode, bgm_gain=bgm_gain)
 
             elif t == "convert":
+                graph = flush(graph)
                 if not current:
                     return create_response(code=400, msg="convert requires a media first"), 400
                 fmt = op.get("format") or "mp4"
@@ -1256,36 +2851,45 @@ def edit_pipeline():
                 conv = vp.convert_format(fmt, quality, resolution)
                 current = conv["file_path"]
                 temp_inter.append(current)
+                graph = PipelineBuilder(current)
                 result["conversion"] = conv
 
             elif t == "screenshot":
+                count = _parse_int(op.get("count") or 3)
+                timestamps = op.get("timestamps")
+                # the graph decodes and re-encodes the video anyway: split the shots off
+                # that same decode instead of reading the result back
+                if graph.encode and graph.screenshots(timestamps=timestamps, count=count):
+                    graph = flush(graph)
+                    continue
+                graph = flush(graph)
                 if not current:
                     return create_response(code=400, msg="screenshot requires a video first"), 400
                 vp = VideoProcessor(current)
-                count = _parse_int(op.get("count") or 3)
-                timestamps = op.get("timestamps")
                 shots = vp.take_screenshots(timestamps=timestamps, count=count)
                 screenshots.extend(shots)
 
             elif t == "metadata":
+                graph = flush(graph)
                 proc, mtype = create_media_processor(current or (local_inputs[0] if local_inputs else None))
                 info = proc.get_video_info() if mtype == "video" else proc.get_audio_info()
 
             else:
                 return create_response(code=400, msg=f"Unknown operation: {t}"), 400
 
+        flush(graph)
         if not current:
             return create_response(code=400, msg="No output produced"), 400
 
         output_file = current
         data = {
-            "output": {"filename": os.path.basename(output_file), "url": create_download_url(os.path.basename(output_file))}
+            "output": output_entry(output_file)
         }
         if screenshots: data["screenshots"] = screenshots
         if info: data["metadata"] = info
         if "conversion" in result: data["conversion"] = result["conversion"]
 
-        cleanup_temp_files(*temp_inputs)
+        enqueue_cleanup(*temp_inputs)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 200, elapsed, data)
         return create_response(msg="Edit pipeline success", data=data)
@@ -1293,17 +2897,13 @@ def edit_pipeline():
     except Exception as e:
         cleanup_temp_files(*(temp_inputs + temp_inter + ([output_file] if output_file else [])))
         log_error(request_id, e, {"endpoint": "/edit"})
-        return create_response(code=500, msg=f"Edit pipeline failed: {str(e)}"), 500
+        return create_response(code=500, msg=f"Edit pipeline failed: {_short_err(e)}"), 500
 
 
 def _has_audio_stream(path):
+    # answered from the cached probe, so asking again about the same file spawns nothing
     try:
-        r = run_cmd(
-            ["ffprobe", "-v", "error", "-select_streams", "a",
-             "-show_entries", "stream=index", "-of", "csv=p=0", path],
-            capture_output=True, text=True
-        )
-        return r.returncode == 0 and r.stdout.strip() != ""
+        return any(s.get("codec_type") == "audio" for s in probe_media(path).get("streams", []))
     except Exception:
         return False
 
@@ -1320,7 +2920,6 @@ def concat_videos():
     request_id = log_request_info()
 
     temp_inputs = []
-    temp_intermediates = []
     output_file = None
 
     try:
@@ -1343,97 +2942,62 @@ def concat_videos():
         # from urls
         urls = data.get("urls")
         if isinstance(urls, str):
-            try:
-                urls = json.loads(urls)
-            except Exception:
-                urls = [u.strip() for u in urls.split(",") if u.strip()]
+            urls = _split_list(urls)
         if urls:
-            for u in urls:
-                p = download_media_from_url(u)
-                temp_inputs.append(p); videos.append(p)
+            paths = download_media_from_urls(urls)
+            temp_inputs.extend(paths); videos.extend(paths)
 
         if len(videos) < 2:
             return create_response(code=400, msg="Need at least 2 videos (files[] or urls[])"), 400
         if len(videos) > 10:
             return create_response(code=400, msg="Too many inputs (max 10)"), 400
 
-        os.makedirs(TEMP_DIR, exist_ok=True)
-
-        # normalize
-        norm_paths = []
-        for idx, src in enumerate(videos, 1):
-            norm_name = f"norm_{uuid.uuid4().hex}_{idx}.mp4"
-            norm_path = os.path.join(TEMP_DIR, norm_name)
-
-            cmd = ["ffmpeg", "-y", "-i", src, "-c:v", "libx264", "-preset", preset, "-crf", crf]
-            if mute:
-                cmd += ["-an"]
-            else:
-                cmd += ["-c:a", "aac"]
-
-            vf = []
-            if resolution:
-                try:
-                    r = VideoProcessor(src)._parse_resolution(resolution)
-                    if r: vf.append(f"scale={r}")
-                except Exception:
-                    pass
-            if fps and fps > 0:
-                vf.append(f"fps={fps}")
-            if vf:
-                cmd.extend(["-vf", ",".join(vf)])
-
-            cmd.append(norm_path)
-
-            logger.debug(f"[concat-normalize] {' '.join(cmd)}")
-            r = run_cmd(cmd, capture_output=True, text=True)
+        # same scale/fps chain for every input, applied inside the concat graph
+        vf = []
+        if resolution:
+            try:
+                r = VideoProcessor._parse_resolution(resolution)
+                if r: vf.extend([f"scale={r}", "setsar=1"])
+            except Exception:
+                pass
+        if fps and fps > 0:
+            vf.append(f"fps={fps}")
+
+        n = len(videos)
+        out_name = f"concat_{token_hex(16)}.mp4"
+        output_file = new_temp_path(out_name)
+
+        def build(encoder):
+            cmd = _concat_cmd(videos, vf, crf, preset, output_file, encoder, audio=not mute)
+            log_cmd("[concat]", cmd)
+            return cmd
+
+        # nothing to rescale or drop and matching streams: join without re-encoding
+        r = None
+        if not vf and _can_concat_copy(videos, audio=not mute):
+            r = _concat_copy(videos, output_file, audio=not mute)
             if r.returncode != 0:
-                raise Exception(f"Normalization failed: {r.stderr}")
-
-            norm_paths.append(norm_path)
-            temp_intermediates.append(norm_path)
-
-        # concat
-        cmd = ["ffmpeg", "-y"]
-        for p in norm_paths:
-            cmd.extend(["-i", p])
-
-        n = len(norm_paths)
-
-        if mute:
-            filter_inputs = "".join([f"[{i}:v:0]" for i in range(n)])
-            filter_graph = f"{filter_inputs}concat=n={n}:v=1:a=0[outv]"
-            out_name = f"concat_{uuid.uuid4().hex}.mp4"
-            output_file = os.path.join(TEMP_DIR, out_name)
-            cmd.extend(["-filter_complex", filter_graph, "-map", "[outv]", "-movflags", "+faststart", output_file])
-        else:
-            filter_inputs = "".join([f"[{i}:v:0][{i}:a:0]" for i in range(n)])
-            filter_graph = f"{filter_inputs}concat=n={n}:v=1:a=1[outv][outa]"
-            out_name = f"concat_{uuid.uuid4().hex}.mp4"
-            output_file = os.path.join(TEMP_DIR, out_name)
-            cmd.extend(["-filter_complex", filter_graph, "-map", "[outv]", "-map", "[outa]", "-movflags", "+faststart", output_file])
-
-        logger.debug(f"[concat] {' '.join(cmd)}")
-        r = run_cmd(cmd, capture_output=True, text=True)
+                logger.warning(f"Stream-copy concat failed, re-encoding: {r.stderr}")
+        if r is None or r.returncode != 0:
+            r = run_h264_ffmpeg(build)
         if r.returncode != 0:
             raise Exception(f"Concat failed: {r.stderr}")
 
-        file_url = create_download_url(os.path.basename(output_file))
         result = {
-            "output": {"filename": os.path.basename(output_file), "url": file_url},
+            "output": output_entry(output_file),
             "count": n,
             "options": {"resolution": resolution or "original", "fps": fps, "crf": crf, "preset": preset, "mute": mute}
         }
 
-        cleanup_temp_files(*temp_inputs)
+        enqueue_cleanup(*temp_inputs)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 200, elapsed, result)
         return create_response(msg="Concat success", data=result)
 
     except Exception as e:
-        cleanup_temp_files(*(temp_inputs + temp_intermediates + ([output_file] if output_file else [])))
+        cleanup_temp_files(*(temp_inputs + ([output_file] if output_file else [])))
         log_error(request_id, e, {"endpoint": "/concat"})
-        return create_response(code=500, msg=f"Concat failed: {str(e)}"), 500
+        return create_response(code=500, msg=f"Concat failed: {_short_err(e)}"), 500
 @app.route("/subtitle", methods=["POST"])
 @require_api_key
 def add_subtitle():
@@ -1441,7 +3005,6 @@ def add_subtitle():
     request_id = log_request_info()
 
     temp_inputs = []
-    temp_intermediates = []
     output_file = None
 
     try:
@@ -1454,7 +3017,9 @@ def add_subtitle():
 
         # video
         if "media_url" in (data or {}) and data.get("media_url"):
-            video_path = download_media_from_url(data.get("media_url")); temp_inputs.append(video_path)
+            video_path = _ensure_ffmpeg_input(data.get("media_url"), "media_url")
+            if not _URL_RE.match(video_path):
+                temp_inputs.append(video_path)
         elif "file" in request.files:
             video_path = save_uploaded_file(request.files["file"]); temp_inputs.append(video_path)
         else:
@@ -1465,8 +3030,8 @@ def add_subtitle():
             sub_path = download_media_from_url(data.get("subtitle_url")); temp_inputs.append(sub_path)
         elif "subtitle" in request.files:
             f = request.files["subtitle"]
-            sub_name = f"sub_{uuid.uuid4().hex}{os.path.splitext(f.filename or '')[1]}"
-            sub_path = os.path.join(TEMP_DIR, sub_name); f.save(sub_path); temp_inputs.append(sub_path)
+            sub_name = f"sub_{token_hex(16)}{os.path.splitext(f.filename or '')[1]}"
+            sub_path = new_temp_path(sub_name); save_stream(f.stream, sub_path); temp_inputs.append(sub_path)
         else:
             return create_response(code=400, msg="Need subtitle_url or subtitle file"), 400
 
@@ -1476,19 +3041,19 @@ def add_subtitle():
             output_file = _apply_hard_subtitle(video_path, sub_path, fonts_dir=fonts_dir, crf=crf, preset=preset)
 
         result = {
-            "output": {"filename": os.path.basename(output_file), "url": create_download_url(os.path.basename(output_file))},
+            "output": output_entry(output_file),
             "mode": mode, "fonts_dir": fonts_dir
         }
 
-        cleanup_temp_files(*temp_inputs)
+        enqueue_cleanup(*temp_inputs)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 200, elapsed, result)
         return create_response(msg="Subtitle applied", data=result)
 
     except Exception as e:
-        cleanup_temp_files(*(temp_inputs + temp_intermediates + ([output_file] if output_file else [])))
+        cleanup_temp_files(*(temp_inputs + ([output_file] if output_file else [])))
         log_error(request_id, e, {"endpoint": "/subtitle"})
-        return create_response(code=500, msg=f"Subtitle failed: {str(e)}"), 500
+        return create_response(code=500, msg=f"Subtitle failed: {_short_err(e)}"), 500
 
 
 @app.route("/info", methods=["POST"])
@@ -1514,7 +3079,7 @@ def get_media_info():
         info = processor.get_video_info() if media_type == "video" else processor.get_audio_info()
         response_data = {"media_type": media_type, "info": info}
 
-        cleanup_temp_files(*temp_files)
+        enqueue_cleanup(*temp_files)
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 200, elapsed, response_data)
         return create_response(msg="Media information extracted successfully", data=response_data)
@@ -1530,7 +3095,7 @@ def get_media_info():
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 500, elapsed)
         log_error(request_id, e, {"endpoint": "/info"})
-        return create_response(code=500, msg=f"Failed to extract media info: {str(e)}"), 500
+        return create_response(code=500, msg=f"Failed to extract media info: {_short_err(e)}"), 500
 
 
 @app.route("/version", methods=["GET"])
@@ -1541,8 +3106,8 @@ def version():
         line0 = (r.stdout or "").splitlines()[0] if r.stdout else ""
         return create_response(msg="OK", data={"ffmpeg": line0})
     except Exception as e:
-        log_error(str(uuid.uuid4())[:8], e, {"endpoint": "/version"})
-        return create_response(code=500, msg=f"Version check failed: {str(e)}"), 500
+        log_error(token_hex(4), e, {"endpoint": "/version"})
+        return create_response(code=500, msg=f"Version check failed: {_short_err(e)}"), 500
 
 
 @app.route("/download/<path:filename>", methods=["GET", "HEAD"])
@@ -1557,17 +3122,40 @@ def download_file(filename):
         temp_abs = os.path.abspath(TEMP_DIR)
         if not file_path.startswith(temp_abs + os.sep):
             return create_response(code=400, msg="Invalid filename"), 400
+        # URL cache entries are other users' inputs, named from the URL alone, and job
+        # status files belong to the key-protected /jobs route: never served here
+        if safe_name.startswith(("cache_", "job_")):
+            logger.warning(f"Request {request_id}: Refused internal file: {safe_name}")
+            return create_response(code=404, msg="File not found"), 404
         
-        if not os.path.exists(file_path):
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
             logger.warning(f"Request {request_id}: File not found: {safe_name}")
             return create_response(code=404, msg="File not found"), 404
 
         auto_delete = request.args.get("auto_delete", "false").lower() == "true"
 
-        file_size = os.path.getsize(file_path)
+        file_size = st.st_size
         logger.info(f"Request {request_id}: Serving file {safe_name} ({file_size} bytes)")
 
-        response = send_file(file_path, as_attachment=True, download_name=safe_name)
+        # Without X-Sendfile / X-Accel-Redirect, gunicorn serves the file through wsgi.file_wrapper,
+        # which uses sendfile(2). auto_delete must stream from here, since the front
+        # server would read the file after call_on_close has already removed it.
+        response = send_file(
+            file_path, request.environ, as_attachment=True, download_name=safe_name,
+            use_x_sendfile=(USE_X_SENDFILE or bool(X_ACCEL_REDIRECT)) and not auto_delete,
+            response_class=app.response_class,
+            # outputs are never rewritten in place, so mtime+size is a strong validator
+            # and repeat fetches get a 304 without reading the file
+            conditional=True,
+            last_modified=st.st_mtime,
+            etag=f"{st.st_mtime_ns:x}-{st.st_size:x}",
+        )
+        if X_ACCEL_REDIRECT and "X-Sendfile" in response.headers:
+            # nginx takes a URI under its internal location instead of a filesystem path
+            del response.headers["X-Sendfile"]
+            response.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT}/{safe_name}"
         try:
             response.headers["Cache-Control"] = "public, max-age=86400"
         except Exception:
@@ -1576,10 +3164,12 @@ def download_file(filename):
         if auto_delete:
             @response.call_on_close
             def cleanup_after_download():
+                # the response already holds the file open, so unlinking cannot cut it short
                 try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info(f"Auto-deleted file after download: {safe_name}")
+                    os.remove(file_path)
+                    logger.info(f"Auto-deleted file after download: {safe_name}")
+                except FileNotFoundError:
+                    pass
                 except Exception as e:
                     logger.error(f"Failed to auto-delete {safe_name}: {e}")
 
@@ -1591,7 +3181,17 @@ def download_file(filename):
         elapsed = (time.time() - start_time) * 1000
         log_response_info(request_id, 500, elapsed)
         log_error(request_id, e, {"endpoint": "/download", "filename": filename})
-        return create_response(code=500, msg=f"Download failed: {str(e)}"), 500
+        return create_response(code=500, msg=f"Download failed: {_short_err(e)}"), 500
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@require_api_key
+def job_status(job_id):
+    """Status of a background /process job (result included once completed)"""
+    status = read_job_status(job_id)
+    if status is None:
+        return create_response(code=404, msg="Job not found"), 404
+    return create_response(msg=f"Job {status['status']}", data=status)
 
 
 @app.errorhandler(413)
@@ -1610,6 +3210,8 @@ def internal_error(e):
 # Ensure temp directory exists
 os.makedirs(TEMP_DIR, exist_ok=True)
 logger.info(f"Temp directory ensured: {TEMP_DIR}")
+# Directory handle for OutputFile; unnamed temp files need Linux O_TMPFILE
+_temp_dir_fd = os.open(TEMP_DIR, os.O_RDONLY | os.O_DIRECTORY) if _O_TMPFILE else None
 
 # Start background cleanup thread
 start_cleanup_thread()
@@ -11,7 +11,8 @@ if [ -f /.dockerenv ]; then
     echo "Running in Docker container"
     echo "Starting FFmpeg Service with Gunicorn..."
     echo "Workers: ${GUNICORN_WORKERS:-4}"
-    echo "Worker Class: ${GUNICORN_WORKER_CLASS:-sync}"
+    echo "Worker Class: ${GUNICORN_WORKER_CLASS:-gthread}"
+    echo "Threads per worker: ${GUNICORN_THREADS:-8}"
     echo "Timeout: ${GUNICORN_TIMEOUT:-120}s"
     echo "Max Requests: ${GUNICORN_MAX_REQUESTS:-1000}"
     echo "Port: ${FLASK_PORT:-8080}"
@@ -20,7 +21,8 @@ if [ -f /.dockerenv ]; then
     exec gunicorn \
         --bind 0.0.0.0:${FLASK_PORT:-8080} \
         --workers ${GUNICORN_WORKERS:-4} \
-        --worker-class ${GUNICORN_WORKER_CLASS:-sync} \
+        --worker-class ${GUNICORN_WORKER_CLASS:-gthread} \
+        --threads ${GUNICORN_THREADS:-8} \
         --timeout ${GUNICORN_TIMEOUT:-120} \
         --max-requests ${GUNICORN_MAX_REQUESTS:-1000} \
         --max-requests-jitter ${GUNICORN_MAX_REQUESTS_JITTER:-100} \